@@ -0,0 +1,1253 @@
+#!/usr/local/bin/python -Wignore::DeprecationWarning
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import os
+import sys
+import re
+import shutil
+import tempfile
+import time
+import random
+import bisect
+import urllib
+import optparse
+import json
+import inspect
+import collections
+import gzip
+import resource
+import multiprocessing
+
+import geoip2.errors
+
+import log2db_ng_field_types
+from log2db_ng_field_types import *
+import log2db_ng_player_events
+from log2db_ng_player_events import UploadSession, UploadSessionPlayerEvents, tokenize_line, tokenize_fields, target_columns, follow_range, loaded_session, file_fingerprint, file_content_hash
+from log2db_ng_parallel import RowStream, ParseWorkerPool
+from log2db_ng_encoders import JSONRowEncoder, make_row_encoder, row_encoders
+import log2db_ng_encoders
+import log2db_ng_compression
+from log2db_ng_compression import open_log_file
+
+bench_fields =  [ \
+                    ('rts',         'rts',          'TimestampField',           True), \
+                    ('ip',          'ip',           'IPv4Field',                True), \
+                    ('ts',          'ts',           'TimestampField',           True), \
+                    ('event',       'event',        'LogCharField',             True), \
+                    ('video_id',    'video_id',     'LogGUIDField',             False), \
+                    ('user_id',     'user_id',      'LogGUIDField',             False), \
+                    ('position',    'position',     'LogFloatField',            False), \
+                    ('duration',    'duration',     'LogFloatField',            False), \
+                    ('title',       'title',        'LogCharField',             False), \
+                    ('referer',     'referer',      'RefererField',             False), \
+                    ('ua',          'user_agent',   'UserAgentField',           False), \
+                    ('error',       'error',        'ErrorFieldType(\'player\')', False), \
+                ]
+
+bench_events = ('start', 'play', 'pause', 'heartbeat', 'heartbeat', 'heartbeat', 'seek', 'end', 'error',)
+
+bench_referers = ( \
+                    'http://rutube.ru/video/%s/', \
+                    'https://www.google.ru/search?q=%s', \
+                    'http%%3A%%2F%%2Fvk.com%%2Fvideo%%3Fid%%3D%s', \
+                    'm.example.com/embed/%s', \
+                 )
+
+bench_user_agents = ( \
+                        'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/41.0.2272.101 Safari/537.36', \
+                        'Mozilla/5.0 (iPhone; CPU iPhone OS 8_2 like Mac OS X) AppleWebKit/600.1.4 (KHTML, like Gecko) Version/8.0 Mobile/12D508 Safari/600.1.4', \
+                        'Mozilla%2F5.0%20(X11%3B%20Linux%20x86_64%3B%20rv%3A36.0)%20Gecko%2F20100101%20Firefox%2F36.0', \
+                    )
+
+def random_guid(rnd):
+    return '%032x' % (rnd.getrandbits(128),)
+
+def zipf_sampler(values, exponent, rnd):
+    cdf = []
+    total = 0.0
+    for rank in xrange(1, len(values) + 1):
+        total += 1.0 / rank ** exponent
+        cdf.append(total)
+
+    return lambda: values[bisect.bisect_left(cdf, rnd.random() * total)]
+
+def generate_lines(count, seed = 0, debug_keys = 1, encoded_ratio = 0.0, bad_ratio = 0.0, ip_skew = 0.0, ip_distinct = 100000, referer_skew = 0.0, referer_distinct = 10000):
+    rnd = random.Random(seed)
+
+    # the knobs draw from a stream of their own, so left at their defaults
+    # they generate the very same lines
+    mix = random.Random(seed + 1)
+
+    ips = zipf_sampler(['%s.%s.%s.%s' % tuple(mix.randint(1, 254) for _ in range(4)) for _ in xrange(ip_distinct)], ip_skew, mix) if ip_skew else None
+    referer_ids = zipf_sampler([random_guid(mix) for _ in xrange(referer_distinct)], referer_skew, mix) if referer_skew else None
+
+    for i in xrange(count):
+        ts = 1420070400 + i
+        video_id = random_guid(rnd)
+        event = rnd.choice(bench_events)
+
+        parts = [ \
+                    str(ts + rnd.randint(0, 5)), \
+                    '%s.%s.%s.%s' % tuple(rnd.randint(1, 254) for _ in range(4)), \
+                    'ts:%s' % (ts,), \
+                    'event:%s' % (event,), \
+                    'video_id:%s' % (video_id,), \
+                    'user_id:%s' % (random_guid(rnd) if rnd.random() > 0.1 else 'undefined',), \
+                    'position:%.3f' % (rnd.random() * 3600,), \
+                    'duration:%s' % (rnd.choice(('%.3f' % (rnd.random() * 3600,), 'NaN', '', 'undefined',)),), \
+                    'title:%s' % (urllib.quote('Видео %s | серия: %s' % (video_id[:6], rnd.randint(1, 20),)),), \
+                    'referer:%s' % (urllib.quote(rnd.choice(bench_referers) % (video_id,)),), \
+                    'ua:%s' % (rnd.choice(bench_user_agents),), \
+                    'debug_%s:%s' % (rnd.randint(0, 9), rnd.getrandbits(32),), \
+                ]
+
+        if rnd.random() < 0.01:
+            parts.append('note:%s' % (urllib.quote('relay|Event:%s|ts:%s' % (rnd.choice(bench_events), ts,)),))
+
+        if event == 'error':
+            parts.append('error:%s' % (urllib.quote('%s,media error' % (rnd.randint(1, 5),)),))
+
+        if ips:
+            parts[1] = ips()
+
+        if referer_ids:
+            parts[9] = 'referer:%s' % (urllib.quote(mix.choice(bench_referers) % (referer_ids(),)),)
+
+        # encoded once more, RecursiveField has to go round twice
+        if encoded_ratio and mix.random() < encoded_ratio:
+            parts[8] = 'title:%s' % (urllib.quote(parts[8][len('title:'):]),)
+            parts[9] = 'referer:%s' % (urllib.quote(parts[9][len('referer:'):]),)
+
+        if debug_keys != 1:
+            parts[11:12] = ['debug_%s:%s' % (mix.randint(0, 99), mix.getrandbits(32),) for _ in xrange(debug_keys)]
+
+        line = '|'.join(parts)
+
+        if bad_ratio and mix.random() < bad_ratio:
+            line = corrupt_line(parts, mix)
+
+        yield line
+
+def corrupt_line(parts, rnd):
+    kind = rnd.choice(('ip', 'ts', 'position', 'truncated',))
+    parts = list(parts)
+
+    if kind == 'ip':
+        parts[1] = '%s.%s.%s' % (rnd.randint(256, 999), rnd.randint(0, 255), rnd.randint(0, 255),)
+    elif kind == 'ts':
+        parts[2] = 'tz' + parts[2][2:]
+    elif kind == 'position':
+        parts[6] = 'position:%s' % (rnd.choice(('1,5', 'abc', '0x10',)),)
+    else:
+        return '|'.join(parts)[:rnd.randint(1, 40)]
+
+    return '|'.join(parts)
+
+bench_clean_samples =   { \
+                            'LogField':                 ('abc',), \
+                            'IPv4Field':                ('10.0.0.1', '192.168.100.200', '256.1.1.1',), \
+                            'GeoIP2CityDBField':        ('10.0.0.1', '77.88.55.66',), \
+                            'GeoIP2CityDBCityField':    ('10.0.0.1', '77.88.55.66',), \
+                            'GeoIP2CityDBRegionField':  ('10.0.0.1', '77.88.55.66',), \
+                            'GeoIP2CityDBCountryField': ('10.0.0.1', '77.88.55.66',), \
+                            'IntField':                 ('123', '', '-42',), \
+                            'FloatField':               ('1.5', 'NaN', '', 'inf',), \
+                            'NullableField':            ('undefined', 'value',), \
+                            'EscapedField':             ('tab\there \\ quote \'',), \
+                            'MultiLineField':           ('one\ntwo\r\nthree',), \
+                            'URLDecodedField':          ('Hello%20World%7C%D0%92',), \
+                            'RecursiveField':           ('double%2520encoded', 'plain',), \
+                            'LowerField':               ('MiXeD',), \
+                            'LimitedLengthField':       ('x' * 2000,), \
+                            'MultiTraitField':          ('abc',), \
+                            'GUIDField':                ('0f8fad5bd9cb469fa16570867728950e', '0F8FAD5B-D9CB-469F-A165-70867728950E',), \
+                            'LogGUIDField':             ('0F8FAD5BD9CB469FA16570867728950E', 'undefined',), \
+                            'LogFloatField':            ('3.25', 'undefined', 'NaN',), \
+                            'LogCharField':             ('%D0%92%D0%B8%D0%B4%D0%B5%D0%BE', 'undefined', 'plain',), \
+                            'TimestampField':           ('1420070400', '1420070400.5',), \
+                            'RefererField':             ('http%3A%2F%2Fvk.com%2Fvideo%3Fid%3D1', 'm.example.com/embed/1',), \
+                            'ErrorField':               ('3%2Cmedia%20error', 'fatal',), \
+                            'UserAgentField':           bench_user_agents, \
+                        }
+
+bench_clean_classes =   { \
+                            'RecursiveField':           RecursiveFieldType(URLDecodedField), \
+                            'LimitedLengthField':       LimitedLengthFieldType(1024), \
+                            'ErrorField':               ErrorFieldType('player'), \
+                        }
+
+bench_geoip_fields = bench_fields + [ \
+                                        ('ip',      'city',         'GeoIP2CityDBCityField',    False), \
+                                        ('ip',      'region',       'GeoIP2CityDBRegionField',  False), \
+                                        ('ip',      'country',      'GeoIP2CityDBCountryField', False), \
+                                     ]
+
+GeoIPNames = collections.namedtuple('GeoIPNames', ('geoname_id', 'iso_code', 'names',))
+GeoIPCity = collections.namedtuple('GeoIPCity', ('city', 'subdivisions', 'country',))
+
+class FakeGeoIPReader(object):
+    # answers like geoip2.database.Reader.city() for any public address, from
+    # a hash of the first three octets, so no mmdb is needed
+    countries = (('RU', 'Russia', 'Россия',), ('UA', 'Ukraine', 'Украина',), ('DE', 'Germany', 'Германия',), ('US', 'United States', 'США',),)
+
+    def city(self, ip):
+        octets = [int(i) for i in ip.split('.')]
+
+        if octets[0] in (10, 127,) or octets[:2] == [192, 168]:
+            raise geoip2.errors.AddressNotFoundError('The address %s is not in the database.' % (ip,))
+
+        key = (octets[0] << 16) + (octets[1] << 8) + octets[2]
+        iso_code, title, title_ru = self.countries[key % len(self.countries)]
+
+        return  GeoIPCity   ( \
+                                city            = GeoIPNames(key, None, {'en': 'City %s' % (key,), 'ru': 'Город %s' % (key,)}), \
+                                subdivisions    = [GeoIPNames(key // 256, '%s-%s' % (iso_code, key % 90 + 10,), {'en': 'Region %s' % (key // 256,)})], \
+                                country         = GeoIPNames(key % len(self.countries), iso_code, {'en': title, 'ru': title_ru}), \
+                            )
+
+    def close(self):
+        pass
+
+def use_fake_geoip():
+    log2db_ng_field_types.close_geoip()
+
+    log2db_ng_field_types.geoip_city = FakeGeoIPReader()
+    log2db_ng_field_types.geoip_city_pid = os.getpid()
+
+def field_classes():
+    return sorted((name, bench_clean_classes.get(name, value)) for name, value in vars(log2db_ng_field_types).iteritems() if inspect.isclass(value) and issubclass(value, LogField))
+
+def legacy_traits_clean(field_class, value):
+    field_class = [i for i in field_class.__mro__ if MultiTraitField in i.__bases__][0]
+
+    for base_class in field_class.__bases__:
+        if base_class != MultiTraitField:
+            value = base_class(value).clean()
+            if value is None:
+                return value
+
+    return value
+
+def count_field_instances(func, values):
+    counter = [0]
+    log_field_init = LogField.__init__
+
+    def counting_init(self, *args, **kwargs):
+        counter[0] += 1
+        log_field_init(self, *args, **kwargs)
+
+    LogField.__init__ = counting_init
+
+    try:
+        for value in values:
+            try:
+                func(value)
+            except Exception:
+                pass
+    finally:
+        LogField.__init__ = log_field_init
+
+    return counter[0]
+
+def bench_traits(iterations):
+    for name, field_class in field_classes():
+        if not (issubclass(field_class, MultiTraitField) and field_class is not MultiTraitField):
+            continue
+
+        samples = bench_clean_samples[name] * iterations
+
+        for label, func in ( \
+                                ('walk', lambda value: legacy_traits_clean(field_class, value)), \
+                                ('compiled', field_class.traits_cleaner), \
+                           ):
+            allocations = count_field_instances(func, samples[:len(samples) // iterations])
+
+            time_start = time.time()
+
+            for sample in samples:
+                try:
+                    func(sample)
+                except Exception:
+                    pass
+
+            elapsed = time.time() - time_start
+
+            print('%-40s %10d values %8.3fs %10.0f ns/value %8.1f fields/value' % ('traits %s (%s)' % (name, label,), len(samples), elapsed, elapsed * 1e9 / len(samples), float(allocations) * iterations / len(samples),))
+
+            record('traits %s (%s)' % (name, label,), len(samples), elapsed, 'values', fields_per_value = float(allocations) * iterations / len(samples))
+
+def bench_clean(iterations):
+    for name, field_class in field_classes():
+        samples = bench_clean_samples.get(name)
+
+        if not samples:
+            print('%-40s %s' % ('clean %s' % (name,), 'no samples',))
+            continue
+
+        failures = 0
+        time_start = time.time()
+
+        for _ in xrange(iterations):
+            for sample in samples:
+                try:
+                    field_class(sample).clean()
+                except Exception:
+                    failures += 1
+
+        elapsed = time.time() - time_start
+        count = iterations * len(samples)
+
+        print('%-40s %10d values %8.3fs %10.0f ns/value %8d failed' % ('clean %s' % (name,), count, elapsed, elapsed * 1e9 / count, failures,))
+
+        record('clean %s' % (name,), count, elapsed, 'values', failed = failures)
+
+def zipf_ips(count, distinct, exponent = 1.1, seed = 0):
+    rnd = random.Random(seed)
+
+    ips = ['%s.%s.%s.%s' % tuple(rnd.randint(1, 254) for _ in range(4)) for _ in xrange(distinct)]
+    sample = zipf_sampler(ips, exponent, rnd)
+
+    return [sample() for _ in xrange(count)]
+
+def bench_session(fields = bench_fields, filename = 'bench.log'):
+    return UploadSessionPlayerEvents.detached(filename, 'player_events', fields)
+
+def write_log_files(directory, lines, count):
+    filenames = []
+
+    for i in xrange(count):
+        filename = os.path.join(directory, 'bench.yastng.%s.log' % (i,))
+
+        with open(filename, 'w') as log_file:
+            for line in lines:
+                log_file.write(line + '\n')
+
+        filenames.append(filename)
+
+    return filenames
+
+results_file = None
+
+def peak_rss():
+    # KB on Linux, and only of children that have been waited for
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+def record(name, count, elapsed, unit = 'lines', **extra):
+    if results_file is None:
+        return
+
+    rss, children_rss = peak_rss()
+
+    result =    { \
+                    'name':                 name, \
+                    'count':                count, \
+                    'unit':                 unit, \
+                    'seconds':              round(elapsed, 6), \
+                    'per_sec':              round(count / elapsed, 1) if elapsed else None, \
+                    'peak_rss_kb':          rss, \
+                    'children_peak_rss_kb': children_rss, \
+                    'cpus':                 multiprocessing.cpu_count(), \
+                }
+
+    result.update(extra)
+
+    results_file.write(json.dumps(result, sort_keys = True) + '\n')
+    results_file.flush()
+
+def report(name, rows, elapsed):
+    print('%-40s %10d lines %8.3fs %12.0f lines/sec' % (name, rows, elapsed, rows / elapsed if elapsed else 0,))
+
+    record(name, rows, elapsed)
+
+bench_edge_lines = ( \
+                    '', \
+                    '1420070400', \
+                    '1420070400|10.0.0.1', \
+                    'ts:1|10.0.0.1|ts:2|TS:3|Event:play', \
+                    '1|2|%s:too_long|%s:just_fits' % ('k' * 33, 'k' * 32,), \
+                    '1|2|no_colon|:empty_id|bad id:x|a.b:c|x:y:z', \
+                    '1|2|a:x%7Cb%3A1|b:2', \
+                    '1|2|b:2|a:x%7Cb%3A1%7Cc%3A3%7CC%3A4%7C%7Cd', \
+                    '1|2|rts:shadow|ip:shadow|a:%7Crts%3A9', \
+                    '1|2|event:pause|debug:x%7Cevent%3Aplay|Debug:y%7Cts%3A5|ts:4', \
+                    '1%7Cts%3A7|2|ts:6|title:a%20%7C%20b%3A%201', \
+                    '1%7Cq%3Aw|2%7C|v:%E2%98%83|w:\xff\xfe|u:%ff', \
+                    'x:1|y:2', \
+                 )
+
+def legacy_line_fields(session, line):
+    def line_to_fields(line):
+        return \
+            {i.groupdict()['id'].lower():i.groupdict()['value'] for i in re.finditer('(?i)(?<=[|])(?P<id>[a-z0-9_-]{,32}):(?P<value>[^|]*)', '|' + line)}
+
+    raw_fields = \
+        collections.defaultdict \
+        ( \
+            lambda: None, \
+            line_to_fields(line) \
+        )
+
+    raw_fields.update(zip(session.anonymous_fields, re.split('[|]', line)))
+
+    fields = {}
+    for k,v in raw_fields.iteritems():
+        try_line = line_to_fields('%s:%s' % (k, URLDecodedField(v).clean(),))
+        fields.update(try_line)
+
+    return fields
+
+def legacy_parse_line(session, line):
+    fields = legacy_line_fields(session, line)
+
+    assert session.mandatory_fields == session.mandatory_fields & set(fields.keys())
+
+    facts = {}
+
+    def process_field(field_from, field_to, field_type, _):
+        if field_from in fields:
+            facts[field_to] = eval('%s(fields[\'%s\'])' % (field_type, field_from,))
+
+    for field in session.fields:
+        process_field(*field)
+
+    return facts
+
+def run(name, func, lines):
+    time_start = time.time()
+
+    # --bad-ratio lines are meant to fail
+    for line in lines:
+        try:
+            func(line)
+        except Exception:
+            pass
+
+    report(name, len(lines), time.time() - time_start)
+
+def check_tokenizer(lines):
+    session = bench_session()
+
+    mismatches = 0
+    for line in bench_edge_lines + tuple(lines):
+        expected = legacy_line_fields(session, line)
+        actual = tokenize_line(line, session.anonymous_fields)
+
+        if expected != actual:
+            mismatches += 1
+            print('tokenizer mismatch for %r:\n  regex:     %r\n  tokenizer: %r' % (line, expected, actual,))
+
+    print('%-40s %10d lines %10d mismatches' % ('tokenize_line vs regex', len(bench_edge_lines) + len(lines), mismatches,))
+
+    projected_mismatches = 0
+    for wanted_fields in (session.wanted_fields, frozenset(['a', 'b', 'c', 'rts',]), frozenset(['ip', 'ts', 'event', 'v', 'w', 'u',]),):
+        for line in bench_edge_lines + tuple(lines):
+            expected = {k:v for k,v in tokenize_line(line, session.anonymous_fields).iteritems() if k in wanted_fields}
+            actual = {k:v for k,v in tokenize_fields(line, session.anonymous_fields, wanted_fields).iteritems() if k in wanted_fields}
+
+            if expected != actual:
+                projected_mismatches += 1
+                print('projected tokenizer mismatch for %r:\n  tokenize_line:   %r\n  tokenize_fields: %r' % (line, expected, actual,))
+
+    print('%-40s %10d lines %10d mismatches' % ('tokenize_fields vs tokenize_line', 3 * (len(bench_edge_lines) + len(lines)), projected_mismatches,))
+
+    return mismatches == 0 and projected_mismatches == 0
+
+bench_golden_rows = ( \
+                        ( \
+                            {'event': 'play'}, \
+                            '{"event": "play"}', \
+                        ), \
+                        ( \
+                            {'title': 'it\'s a \\ "quoted"\n\ttitle \xd0\x92 /x'}, \
+                            '{"title": "it\\\'s a \\\\\\\\ \\\\"quoted\\\\"\\\\n\\\\ttitle \\\\u0412 /x"}', \
+                        ), \
+                        ( \
+                            {'ts': 1420070400, 'position': 12.5, 'user_id': None, 'error': {'code': 3, 'name': 'player', 'msg': 'media error'}}, \
+                            '{"position": 12.5, "user_id": null, "ts": 1420070400, "error": {"msg": "media error", "code": 3, "name": "player"}}', \
+                        ), \
+                    )
+
+def prepared_facts(lines):
+    session = bench_session()
+
+    res = []
+    for line in lines:
+        try:
+            res.append({k:v.clean() for k,v in session.parse_line(line).iteritems()})
+        except Exception:
+            pass
+
+    return res
+
+def check_row_encoders(lines):
+    encoder = JSONRowEncoder()
+    failures = 0
+
+    for facts, expected in bench_golden_rows:
+        if encoder.encode(facts) != expected:
+            failures += 1
+            print('golden row mismatch for %r:\n  expected: %s\n  json:     %s' % (facts, expected, encoder.encode(facts),))
+
+    facts_list = prepared_facts(lines)
+
+    for facts in facts_list:
+        expected = json.dumps(facts).encode('string-escape')
+
+        if encoder.encode(facts) != expected:
+            failures += 1
+            print('json row mismatch:\n  expected: %s\n  json:     %s' % (expected, encoder.encode(facts),))
+
+        if log2db_ng_encoders.ujson is not None:
+            if json.loads(make_row_encoder('ujson').encode(facts)) != json.loads(json.dumps(facts)):
+                failures += 1
+                print('ujson row mismatch for %r' % (facts,))
+
+    print('%-40s %10d rows  %10d mismatches' % ('row encoders vs golden output', len(bench_golden_rows) + len(facts_list), failures,))
+
+    return failures == 0
+
+bench_column_edge_values = ('', ' 12 ', '+5', '-0', '12.0', '1e3', '1e400', '-inf', 'Infinity', 'nan', 'undefined', 'UNDEFINED', '0x10', '1\x00', '99999999999999999999', 'abc',)
+
+bench_cache_edge_values = ( \
+                            'http://vk.com/a\\b', \
+                            'http://vk.com/a\\\\b', \
+                            'http://vk.com/a%5Cb', \
+                            'http://vk.com/"q"?x=\'1\'', \
+                            'http%3A%2F%2Fvk.com%2F%22q%22', \
+                            'http://\xd0\xbf\xd1\x80\xd0\xb8\xd0\xbc\xd0\xb5\xd1\x80.\xd1\x80\xd1\x84/\xd0\xb2\xd0\xb8\xd0\xb4\xd0\xb5\xd0\xbe', \
+                            'http%3A%2F%2Fvk.com%2F%D0%B2%D0%B8%D0%B4%D0%B5%D0%BE', \
+                            'http://vk.com/\xff\xfe', \
+                            'http%3A%2F%2Fvk.com%2Fvideo%3Fid%3D1', \
+                            'http%253A%252F%252Fvk.com%252Fvideo', \
+                            'Mozilla/5.0 "quoted" \\ \xd0\x92', \
+                        )
+
+def check_value_caches(lines):
+    values = list(bench_cache_edge_values) + [facts['referer'] for facts in (tokenize_line(line, ('rts', 'ip',)) for line in lines) if 'referer' in facts]
+
+    mismatches = 0
+    checked = 0
+
+    for field_class in (RefererField, UserAgentField,):
+        cache = field_class.cache
+
+        try:
+            field_class.cache = LRUCache(0)
+            expected = [field_class(value).clean() for value in values]
+
+            # twice over, so every value is cleaned once more from the cache
+            field_class.cache = LRUCache(16 * 1024 * 1024, cache.weight)
+            actual = [field_class(value).clean() for value in values + values[::-1]]
+
+            stats = field_class.cache.stats()
+        finally:
+            field_class.cache = cache
+
+        for value, expected_value, actual_value, reversed_value in zip(values, expected, actual, actual[::-1]):
+            checked += 1
+
+            if not expected_value == actual_value == reversed_value:
+                mismatches += 1
+                print('%s cache mismatch for %r:\n  uncached: %r\n  cached:   %r\n  repeated: %r' % (field_class.__name__, value, expected_value, actual_value, reversed_value,))
+
+        if stats['misses'] != len(set(values)):
+            mismatches += 1
+            print('%s cache missed %s times on %s distinct values' % (field_class.__name__, stats['misses'], len(set(values)),))
+
+    print('%-40s %10d values %10d mismatches' % ('cached vs uncached values', checked, mismatches,))
+
+    return mismatches == 0
+
+def check_column_cleaners(lines):
+    rnd = random.Random(0)
+    failures = 0
+    count = 0
+
+    for name, field_class in field_classes():
+        if name not in bench_clean_samples:
+            continue
+
+        samples = bench_clean_samples[name] + bench_column_edge_values
+
+        cleaner = field_class.compile_column_cleaner()
+
+        for size in (0, 1, 2, 7, 64, 1024,):
+            values = [rnd.choice(samples) for _ in xrange(size)]
+
+            expected = []
+            expected_failed = []
+
+            for i, value in enumerate(values):
+                try:
+                    expected.append(field_class(value).clean())
+                except Exception:
+                    expected.append(None)
+                    expected_failed.append(i)
+
+            res, failed = cleaner(values)
+            count += size
+
+            # repr tells 1 from 1.0 and 1L
+            if map(repr, res) != map(repr, expected) or failed != expected_failed:
+                failures += 1
+                print('column clean mismatch for %s on %r' % (name, values,))
+
+    session = bench_session()
+    lines = list(lines) + list(bench_edge_lines)
+
+    def prepare(column_rows):
+        log2db_ng_player_events.column_rows = column_rows
+        rejected = []
+
+        try:
+            rows = list(session.prepare(lines, lambda row_number, info, line: rejected.append((row_number, info, line,)), lambda: None))
+        finally:
+            log2db_ng_player_events.column_rows = 0
+
+        return rows, rejected
+
+    expected = prepare(0)
+
+    for column_rows in (1, 7, 1024,):
+        if prepare(column_rows) != expected:
+            failures += 1
+            print('prepare with %s row columns differs from row by row' % (column_rows,))
+
+    print('%-40s %10d values %9d mismatches' % ('column cleaners vs scalar clean', count + 3 * len(lines), failures,))
+
+    return failures == 0
+
+def seed_upload_session_field(cursor, data_type, fields):
+    cursor.execute('delete from upload_session_field where data_type = %s', (data_type,))
+    cursor.executemany('insert into upload_session_field values (%s, %s, %s, %s, %s)', [(data_type,) + tuple(field) for field in fields])
+
+    # the loader keeps mappings for a while, this one has to be seen at once
+    log2db_ng_player_events.field_mappings.pop(data_type, None)
+
+def create_upload_schema(conn, name, fields = bench_fields):
+    cursor = conn.cursor()
+
+    cursor.execute('select 1 from pg_namespace where nspname = \'upload\'')
+    if cursor.fetchone():
+        print('%-40s schema upload already exists, use a scratch database' % (name,))
+        conn.close()
+
+        return None
+
+    cursor.execute  ( \
+                        ' \
+                            create schema upload; \
+                            set search_path = upload; \
+                            create table upload_session (id serial primary key, log_filename text, data_type text, rows_processed int, rows_prepared int, ts_min int, ts_max int, dt date, file_size bigint, head_hash text, content_hash bigint); \
+                            create index on upload_session (data_type, file_size, head_hash); \
+                            create table upload_data (session_id int, row json); \
+                            create table upload_session_field (data_type text, field_from text, field_to text, field_type text, is_mandatory boolean); \
+                            create table player_events_upload_data (session_id bigint, row jsonb) partition by range (session_id); \
+                            create table player_events_upload_data_default partition of player_events_upload_data default; \
+                            create table upload_checkpoint (log_filename text, inode bigint, data_type text, file_offset bigint, session_id int, primary key (log_filename, inode, data_type)); \
+                        ' \
+                    )
+
+    seed_upload_session_field(cursor, 'player_events', fields)
+    conn.commit()
+
+    return cursor
+
+def drop_upload_schema(conn):
+    conn.rollback()
+
+    cursor = conn.cursor()
+    cursor.execute('drop schema upload cascade')
+
+    conn.commit()
+    conn.close()
+
+def check_target_load(lines, dsn):
+    import psycopg2
+
+    conn = psycopg2.connect(dsn)
+
+    cursor = create_upload_schema(conn, 'target load vs staging load')
+    if cursor is None:
+        return False
+
+    directory = tempfile.mkdtemp(prefix = 'log2db_ng_check.')
+    saved = (log2db_ng_player_events.pgsql_conn, log2db_ng_player_events.row_encoder, log2db_ng_player_events.target_table,)
+
+    try:
+        filename, = write_log_files(directory, lines, 1)
+        log2db_ng_player_events.pgsql_conn = conn
+
+        sessions = []
+        for target_table, stream in ((None, False,), ('player_events_upload_data', False,), ('player_events_upload_data', True,),):
+            log2db_ng_player_events.target_table = target_table
+            log2db_ng_player_events.row_encoder = make_row_encoder('auto', binary = bool(target_table))
+
+            if target_table:
+                log2db_ng_player_events.row_encoder.set_columns(*target_columns(conn, target_table))
+
+            with UploadSession(filename, 'player_events') as log_session:
+                log_session.fingerprint = file_fingerprint(filename)
+                log_session.parse(stream = stream)
+                sessions.append(log_session.session_id)
+
+        # the same lines again, appended in two goes with a torn last line
+        # in between, must come out of --follow exactly once
+        follow_filename = os.path.join(directory, 'follow.yastng.log')
+        torn = len(lines) // 2
+
+        with open(follow_filename, 'w') as log_file:
+            log_file.write('\n'.join(lines[:torn]) + '\n' + lines[torn][:10])
+
+        follow_sessions = []
+        for follow_lines in (None, [lines[torn][10:]] + lines[torn + 1:],):
+            if follow_lines:
+                with open(follow_filename, 'a') as log_file:
+                    log_file.write('\n'.join(follow_lines) + '\n')
+
+            with UploadSession(follow_filename, 'player_events') as log_session:
+                log_session.set_range(*follow_range(conn, follow_filename, 'player_events'))
+                log_session.parse()
+                follow_sessions.append(log_session.session_id)
+
+        failures = 0
+
+        cursor.execute('select row::text from player_events_upload_data where session_id in %s order by 1', (tuple(follow_sessions),))
+        follow_rows = cursor.fetchall()
+
+        cursor.execute('select id, rows_processed, rows_prepared, ts_min, ts_max, dt from upload_session where id in %s order by id', (tuple(sessions),))
+        (_, staging_summary), (_, target_summary), (_, stream_summary) = [(row[0], row[1:],) for row in cursor.fetchall()]
+
+        cursor.execute('select row::jsonb::text from player_events_upload_data_%s order by 1' % (sessions[0],))
+        staging_rows = cursor.fetchall()
+
+        for session_id, summary in zip(sessions[1:], (target_summary, stream_summary,)):
+            cursor.execute('select row::text from player_events_upload_data where session_id = %s order by 1', (session_id,))
+
+            if cursor.fetchall() != staging_rows:
+                failures += 1
+                print('target rows differ from staging rows for session %s' % (session_id,))
+
+            if summary != staging_summary:
+                failures += 1
+                print('target upload_session %r differs from staging %r' % (summary, staging_summary,))
+
+        if follow_rows != staging_rows:
+            failures += 1
+            print('follow rows differ from staging rows')
+
+        # same size and head, one byte off in the middle
+        changed_filename = os.path.join(directory, 'changed.yastng.log')
+        with open(filename) as log_file:
+            content = log_file.read()
+
+        middle = len(content) // 2
+        with open(changed_filename, 'w') as log_file:
+            log_file.write(content[:middle] + ('0' if content[middle] != '0' else '1') + content[middle + 1:])
+
+        if loaded_session(conn, filename, 'player_events', file_fingerprint(filename)) != sessions[0]:
+            failures += 1
+            print('loaded file not found by its fingerprint')
+
+        if loaded_session(conn, changed_filename, 'player_events', file_fingerprint(changed_filename)) is not None:
+            failures += 1
+            print('changed file taken for a loaded one')
+
+        print('%-40s %10d rows  %10d mismatches' % ('target load vs staging load', len(staging_rows), failures,))
+
+        return failures == 0
+    finally:
+        (log2db_ng_player_events.pgsql_conn, log2db_ng_player_events.row_encoder, log2db_ng_player_events.target_table,) = saved
+
+        shutil.rmtree(directory)
+
+        drop_upload_schema(conn)
+
+def bench_upload(lines, dsn, worker_counts):
+    import psycopg2
+
+    conn = psycopg2.connect(dsn)
+
+    if create_upload_schema(conn, 'upload', bench_geoip_fields) is None:
+        return
+
+    directory = tempfile.mkdtemp(prefix = 'log2db_ng_bench.')
+    saved = (log2db_ng_player_events.pgsql_conn, log2db_ng_player_events.row_encoder, log2db_ng_player_events.target_table, log2db_ng_player_events.print_errors,)
+
+    try:
+        filename, = write_log_files(directory, lines, 1)
+
+        log2db_ng_player_events.pgsql_conn = conn
+        log2db_ng_player_events.print_errors = 0
+
+        modes = [('staging', None, False, 0,), ('staging, stream', None, True, 0,), ('target', 'player_events_upload_data', False, 0,), ('target, stream', 'player_events_upload_data', True, 0,)]
+        modes += [('target, %s workers' % (worker_count,), 'player_events_upload_data', False, worker_count,) for worker_count in worker_counts]
+
+        for label, target_table, stream, worker_count in modes:
+            log2db_ng_player_events.target_table = target_table
+            log2db_ng_player_events.row_encoder = make_row_encoder('auto', binary = bool(target_table))
+
+            if target_table:
+                log2db_ng_player_events.row_encoder.set_columns(*target_columns(conn, target_table))
+                conn.rollback()
+
+            parse_pool = ParseWorkerPool(worker_count) if worker_count else None
+
+            try:
+                time_start = time.time()
+
+                with UploadSession(filename, 'player_events') as log_session:
+                    log_session.progress = lambda: None
+                    log_session.parse(parse_pool, stream = stream)
+
+                elapsed = time.time() - time_start
+            finally:
+                if parse_pool:
+                    parse_pool.close()
+
+            print('%-40s %10d lines %8.3fs %12.0f lines/sec %8d rejected' % ('upload (%s)' % (label,), len(lines), elapsed, len(lines) / elapsed if elapsed else 0, log_session.rows_processed - log_session.rows_prepared,))
+
+            record('upload (%s)' % (label,), len(lines), elapsed, rejected = log_session.rows_processed - log_session.rows_prepared)
+    finally:
+        (log2db_ng_player_events.pgsql_conn, log2db_ng_player_events.row_encoder, log2db_ng_player_events.target_table, log2db_ng_player_events.print_errors,) = saved
+
+        shutil.rmtree(directory)
+
+        drop_upload_schema(conn)
+
+def bench_row_encoders(lines):
+    facts_list = prepared_facts(lines)
+
+    run('encode (json.dumps + string-escape)', lambda facts: json.dumps(facts).encode('string-escape'), facts_list)
+
+    for name in sorted(row_encoders):
+        try:
+            encoder = make_row_encoder(name)
+        except ValueError as e:
+            print('%-40s %s' % ('encode (%s)' % (name,), e,))
+            continue
+
+        run('encode (%s)' % (name,), encoder.encode, facts_list)
+
+def bench_column_clean(iterations):
+    for name in ('IntField', 'FloatField', 'TimestampField', 'LogFloatField',):
+        field_class = getattr(log2db_ng_field_types, name)
+
+        values = list(bench_clean_samples[name]) * iterations
+        cleaner = field_class.compile_column_cleaner()
+
+        for label, func in ( \
+                                ('scalar', lambda values: [field_class(value).clean() for value in values]), \
+                                ('column', cleaner), \
+                           ):
+            time_start = time.time()
+
+            for i in xrange(0, len(values), 1024):
+                func(values[i:i + 1024])
+
+            elapsed = time.time() - time_start
+
+            print('%-40s %10d values %8.3fs %10.0f ns/value' % ('clean %s (%s)' % (name, label,), len(values), elapsed, elapsed * 1e9 / len(values),))
+
+            record('clean %s (%s)' % (name, label,), len(values), elapsed, 'values')
+
+def bench_prepare_columns(lines):
+    session = bench_session()
+
+    for column_rows in (0, 256, 1024, 4096,):
+        log2db_ng_player_events.column_rows = column_rows
+
+        try:
+            time_start = time.time()
+
+            for _ in session.prepare(lines, lambda *args: None, lambda: None):
+                pass
+
+            report('prepare (%s row columns)' % (column_rows,) if column_rows else 'prepare (row by row)', len(lines), time.time() - time_start)
+        finally:
+            log2db_ng_player_events.column_rows = 0
+
+def bench_skip(lines):
+    saved = log2db_ng_player_events.skip_values
+
+    for label, skip_values in (('no skip', {},), ('skip event=heartbeat', {'event': set(['heartbeat'])},),):
+        log2db_ng_player_events.skip_values = skip_values
+
+        try:
+            session = bench_session()
+
+            time_start = time.time()
+
+            for _ in session.prepare(lines, lambda *args: None, lambda: None):
+                pass
+
+            elapsed = time.time() - time_start
+        finally:
+            log2db_ng_player_events.skip_values = saved
+
+        skipped = session.metrics.counters['rows_skipped']
+
+        print('%-40s %10d lines %8.3fs %12.0f lines/sec %8d skipped' % ('prepare (%s)' % (label,), len(lines), elapsed, len(lines) / elapsed if elapsed else 0, skipped,))
+
+        record('prepare (%s)' % (label,), len(lines), elapsed, skipped = skipped)
+
+def bench_tokenizer(lines):
+    session = bench_session()
+
+    run('line fields (legacy regex)', lambda line: legacy_line_fields(session, line), lines)
+    run('line fields (tokenize_line)', lambda line: tokenize_line(line, session.anonymous_fields), lines)
+    run('line fields (tokenize_fields)', lambda line: tokenize_fields(line, session.anonymous_fields, session.wanted_fields), lines)
+
+def bench_parse_line(lines):
+    session = bench_session()
+
+    run('parse_line (legacy eval)', lambda line: legacy_parse_line(session, line), lines)
+    run('parse_line (field plan)', session.parse_line, lines)
+
+def write_compressed_files(directory, lines):
+    filename, = write_log_files(directory, lines, 1)
+
+    with open(filename, 'r') as log_file:
+        data = log_file.read()
+
+    filenames = [filename]
+
+    # two members, like logs appended to by separate gzip runs
+    with open(filename + '.gz', 'wb') as gz_file:
+        for part in (data[:len(data) // 2], data[len(data) // 2:],):
+            with gzip.GzipFile(fileobj = gz_file, mode = 'wb') as member:
+                member.write(part)
+
+    filenames.append(filename + '.gz')
+
+    if log2db_ng_compression.zstandard is not None:
+        with open(filename + '.zst', 'wb') as zst_file:
+            zst_file.write(log2db_ng_compression.zstandard.ZstdCompressor().compress(data))
+
+        filenames.append(filename + '.zst')
+
+    return filenames
+
+def check_compressed_input(lines):
+    directory = tempfile.mkdtemp(prefix = 'log2db_ng_check.')
+
+    try:
+        filenames = write_compressed_files(directory, lines)
+
+        with open(filenames[0], 'r') as log_file:
+            expected = list(log_file)
+
+        mismatches = 0
+        for filename in filenames[1:]:
+            with open_log_file(filename) as log_file:
+                if list(log_file) != expected:
+                    mismatches += 1
+                    print('decompressed lines of %s differ from the plain file' % (os.path.basename(filename),))
+    finally:
+        shutil.rmtree(directory)
+
+    print('%-40s %10d files %10d mismatches' % ('compressed input vs plain', len(filenames) - 1, mismatches,))
+
+    return mismatches == 0
+
+def check_content_hash(lines):
+    directory = tempfile.mkdtemp(prefix = 'log2db_ng_check.')
+
+    try:
+        filenames = write_compressed_files(directory, lines)
+        session = bench_session()
+        session.reject = lambda *args: None
+        session.progress = lambda: None
+
+        parse_pool = ParseWorkerPool(2)
+
+        mismatches = 0
+        try:
+            for filename in filenames:
+                expected = file_content_hash(filename)
+
+                with open_log_file(filename) as log_file:
+                    for _ in session.prepare(log_file, lambda *args: None, lambda: None):
+                        pass
+
+                hashes = [session.content_hash]
+
+                # chunked where the file allows it, so chunk hashes get chained
+                for _ in session.receive(parse_pool.file_results(parse_pool.submit_file(UploadSessionPlayerEvents, session.data_type, session.get_state(), filename, 65536))):
+                    pass
+
+                hashes.append(session.content_hash)
+
+                if hashes != [expected] * 2:
+                    mismatches += 1
+                    print('content hash of %s is %s, parsed in process and in chunks %r' % (os.path.basename(filename), expected, hashes,))
+        finally:
+            parse_pool.close()
+
+        print('%-40s %10d files %10d mismatches' % ('parse content hash vs file hash', len(filenames), mismatches,))
+
+        return mismatches == 0
+    finally:
+        shutil.rmtree(directory)
+
+def bench_compressed_input(lines):
+    directory = tempfile.mkdtemp(prefix = 'log2db_ng_bench.')
+
+    try:
+        session = bench_session()
+
+        for filename in write_compressed_files(directory, lines):
+            time_start = time.time()
+
+            with open_log_file(filename) as log_file:
+                for _ in log_file:
+                    pass
+
+            report('read lines (%s)' % (os.path.basename(filename),), len(lines), time.time() - time_start)
+
+            time_start = time.time()
+
+            with open_log_file(filename) as log_file:
+                for _ in session.prepare(log_file, lambda *args: None, lambda: None):
+                    pass
+
+            report('prepare (%s)' % (os.path.basename(filename),), len(lines), time.time() - time_start)
+    finally:
+        shutil.rmtree(directory)
+
+def bench_workers(lines, file_count, worker_counts, chunk_size = None):
+    directory = tempfile.mkdtemp(prefix = 'log2db_ng_bench.')
+
+    try:
+        filenames = write_log_files(directory, lines, file_count)
+        session = bench_session()
+        session.session_id = 0
+
+        def drain_copy(rows):
+            copy_file = RowStream(session.copy_row(row) for row in rows)
+
+            while copy_file.read(8192):
+                pass
+
+        time_start = time.time()
+
+        for filename in filenames:
+            with open(filename, 'r') as log_file:
+                drain_copy(session.prepare(log_file, lambda *args: None, lambda: None))
+
+        report('prepare (in process)', len(lines) * file_count, time.time() - time_start)
+
+        # worker counts above the CPU count only measure contention
+        print('%-40s %s' % ('workers', '%s CPUs' % (multiprocessing.cpu_count(),),))
+
+        for worker_count in worker_counts:
+            parse_pool = ParseWorkerPool(worker_count)
+
+            time_start = time.time()
+
+            file_tasks = [parse_pool.submit_file(UploadSessionPlayerEvents, session.data_type, session.get_state(), filename, chunk_size) for filename in filenames]
+
+            for tasks in file_tasks:
+                drain_copy(row for message in parse_pool.file_results(tasks) if message[0] == 'rows' for row in message[1])
+
+            report('prepare (%s workers%s)' % (worker_count, ', %s byte chunks' % (chunk_size,) if chunk_size else '',), len(lines) * file_count, time.time() - time_start)
+
+            parse_pool.close()
+    finally:
+        shutil.rmtree(directory)
+
+def bench_geoip(count, distinct, cache_sizes):
+    ips = zipf_ips(count, distinct)
+    geoip_cache = GeoIP2CityDBField.cache
+
+    try:
+        for cache_size in cache_sizes:
+            GeoIP2CityDBField.cache = LRUCache(cache_size)
+
+            time_start = time.time()
+
+            for ip in ips:
+                GeoIP2CityDBCityField(ip).clean()
+                GeoIP2CityDBRegionField(ip).clean()
+                GeoIP2CityDBCountryField(ip).clean()
+
+            elapsed = time.time() - time_start
+            stats = GeoIP2CityDBField.cache.stats()
+
+            print('%-40s %10d ips   %8.3fs %12.0f ips/sec %6.1f%% hits %8d lookups' % ('geoip zipf (cache %s)' % (cache_size,), count, elapsed, count / elapsed if elapsed else 0, 100.0 * stats['hits'] / (stats['hits'] + stats['misses']), stats['misses'],))
+
+            record('geoip zipf (cache %s)' % (cache_size,), count, elapsed, 'ips', lookups = stats['misses'])
+    finally:
+        GeoIP2CityDBField.cache = geoip_cache
+
+def parse_args():
+    usage = "usage: %prog [options]"
+    description = "Benchmark log2db_ng parsing on synthetic player_events lines"
+
+    parser = optparse.OptionParser(usage = usage, description = description)
+
+    parser.add_option("-n", "--lines",
+                type    = "int",
+                dest    = "lines",
+                default = 100000,
+                help    = "number of synthetic lines")
+
+    parser.add_option("-s", "--seed",
+                type    = "int",
+                dest    = "seed",
+                default = 0,
+                help    = "random seed")
+
+    parser.add_option("-c", "--check",
+                action  = "store_true",
+                dest    = "check",
+                default = False,
+                help    = "only compare optimized paths against the legacy ones")
+
+    parser.add_option("-f", "--files",
+                type    = "int",
+                dest    = "files",
+                default = 8,
+                help    = "number of synthetic files for the worker benchmark")
+
+    parser.add_option("-w", "--workers",
+                type    = "string",
+                dest    = "workers",
+                default = "1,2,4,8",
+                help    = "comma separated worker counts to benchmark")
+
+    parser.add_option("-C", "--chunk-size",
+                type    = "int",
+                dest    = "chunk_size",
+                default = 256,
+                help    = "KB per chunk for the single file chunked worker benchmark")
+
+    parser.add_option("-g", "--geoip-ips",
+                type    = "int",
+                dest    = "geoip_ips",
+                default = 100000,
+                help    = "distinct IPs in the Zipf distributed GeoIP benchmark stream and in --ip-skew lines")
+
+    parser.add_option("-G", "--geoip-db",
+                type    = "string",
+                dest    = "geoip_db",
+                default = None,
+                help    = "GeoIP2 City mmdb to benchmark against, a fake in-process reader is used without one")
+
+    parser.add_option("-k", "--debug-keys",
+                type    = "int",
+                dest    = "debug_keys",
+                default = 1,
+                help    = "diagnostic keys no mapping uses on every line")
+
+    parser.add_option("-e", "--encoded-ratio",
+                type    = "float",
+                dest    = "encoded_ratio",
+                default = 0.0,
+                help    = "share of lines with title and referer URL-encoded twice")
+
+    parser.add_option("-x", "--bad-ratio",
+                type    = "float",
+                dest    = "bad_ratio",
+                default = 0.0,
+                help    = "share of lines with a bad IP, a missing ts, a bad float or cut short")
+
+    parser.add_option("-i", "--ip-skew",
+                type    = "float",
+                dest    = "ip_skew",
+                default = 0.0,
+                help    = "Zipf exponent of the line IPs over --geoip-ips addresses, 0 for uniformly random ones")
+
+    parser.add_option("-R", "--referer-skew",
+                type    = "float",
+                dest    = "referer_skew",
+                default = 0.0,
+                help    = "Zipf exponent of the referer video ids over 10000 ids, 0 for the line's own video id")
+
+    parser.add_option("-b", "--bench",
+                type    = "string",
+                dest    = "bench",
+                default = None,
+                help    = "comma separated benchmarks to run (%s), all by default; run one at a time for a peak RSS of its own" % (', '.join(bench_names),))
+
+    parser.add_option("-o", "--results",
+                type    = "string",
+                dest    = "results",
+                default = None,
+                help    = "append one JSON object per result (rate, peak RSS) to this file, - for stdout")
+
+    parser.add_option("-r", "--clean-iterations",
+                type    = "int",
+                dest    = "clean_iterations",
+                default = 20000,
+                help    = "iterations over the samples of every field type in the clean() benchmark")
+
+    parser.add_option("-p", "--pg-dsn",
+                type    = "string",
+                dest    = "pg_dsn",
+                default = None,
+                help    = "scratch PostgreSQL database to check target table loading against staging tables and to benchmark full uploads in")
+
+    (prog_options, prog_args) = parser.parse_args()
+
+    if prog_options.bench:
+        unknown = set(prog_options.bench.split(',')) - set(bench_names)
+
+        if unknown:
+            parser.error('unknown benchmarks %s' % (', '.join(sorted(unknown)),))
+
+    return (prog_options, prog_args)
+
+bench_names = ('tokenizer', 'parse_line', 'encoders', 'compressed', 'columns', 'skip', 'clean', 'column_clean', 'traits', 'geoip', 'workers', 'upload',)
+
+def main():
+    global results_file
+
+    (prog_options, prog_args) = parse_args()
+
+    if prog_options.geoip_db:
+        configure_geoip(prog_options.geoip_db)
+    else:
+        use_fake_geoip()
+
+    if prog_options.results == '-':
+        results_file = sys.stdout
+    elif prog_options.results:
+        results_file = open(prog_options.results, 'a')
+
+    lines = list(generate_lines(prog_options.lines, prog_options.seed, prog_options.debug_keys, prog_options.encoded_ratio, prog_options.bad_ratio, prog_options.ip_skew, prog_options.geoip_ips, prog_options.referer_skew))
+
+    if not (check_tokenizer(lines) & check_row_encoders(lines) & check_compressed_input(lines) & check_column_cleaners(lines) & check_value_caches(lines) & check_content_hash(lines)):
+        sys.exit(1)
+
+    if prog_options.pg_dsn and not check_target_load(lines[:10000], prog_options.pg_dsn):
+        sys.exit(1)
+
+    if prog_options.check:
+        return
+
+    worker_counts = [int(i) for i in prog_options.workers.split(',')]
+
+    benches =   { \
+                    'tokenizer':    lambda: bench_tokenizer(lines), \
+                    'parse_line':   lambda: bench_parse_line(lines), \
+                    'encoders':     lambda: bench_row_encoders(lines), \
+                    'compressed':   lambda: bench_compressed_input(lines), \
+                    'columns':      lambda: bench_prepare_columns(lines), \
+                    'skip':         lambda: bench_skip(lines), \
+                    'clean':        lambda: bench_clean(prog_options.clean_iterations), \
+                    'column_clean': lambda: bench_column_clean(prog_options.clean_iterations), \
+                    'traits':       lambda: bench_traits(prog_options.clean_iterations), \
+                    'geoip':        lambda: bench_geoip(prog_options.lines, prog_options.geoip_ips, (1, 1024, 65536,)), \
+                    'workers':      lambda: (bench_workers(lines, prog_options.files, worker_counts), bench_workers(lines, 1, worker_counts, prog_options.chunk_size * 1024)), \
+                    'upload':       lambda: bench_upload(lines, prog_options.pg_dsn, worker_counts) if prog_options.pg_dsn else print('%-40s %s' % ('upload', 'needs --pg-dsn',)), \
+                }
+
+    for name in prog_options.bench.split(',') if prog_options.bench else bench_names:
+        benches[name]()
+
+if __name__ == "__main__":
+    main()
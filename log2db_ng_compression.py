@@ -0,0 +1,79 @@
+#!/usr/local/bin/python -Wignore::DeprecationWarning
+# -*- coding: utf-8 -*-
+
+import os
+import io
+import gzip
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+compression_magic = ( \
+                        ('gzip',    '\x1f\x8b',), \
+                        ('zstd',    '\x28\xb5\x2f\xfd',), \
+                    )
+
+compression_extensions =    { \
+                                '.gz':      'gzip', \
+                                '.zst':     'zstd', \
+                            }
+
+def detect_compression(filename):
+    with open(filename, 'rb') as log_file:
+        head = log_file.read(4)
+
+    for compression, magic in compression_magic:
+        if head.startswith(magic):
+            return compression
+
+    # too short to carry a magic number, trust the name
+    if len(head) < 4:
+        return compression_extensions.get(os.path.splitext(filename)[1])
+
+    return None
+
+def is_compressed(filename):
+    return detect_compression(filename) is not None
+
+class DecompressedStream(io.RawIOBase):
+    def __init__(self, reader, raw_file):
+        self.reader = reader
+        self.raw_file = raw_file
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.reader.read(len(buffer))
+        buffer[:len(data)] = data
+
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self.reader.close()
+            self.raw_file.close()
+
+        super(DecompressedStream, self).close()
+
+def open_log_file(filename, buffer_size = 1024 * 1024):
+    compression = detect_compression(filename)
+
+    if compression is None:
+        return open(filename, 'r')
+
+    raw_file = open(filename, 'rb')
+
+    if compression == 'gzip':
+        reader = gzip.GzipFile(fileobj = raw_file, mode = 'rb')
+    else:
+        if zstandard is None:
+            raw_file.close()
+            raise ValueError('zstandard is not installed, can not read %s' % (filename,))
+
+        reader = zstandard.ZstdDecompressor().stream_reader(raw_file, read_size = buffer_size, read_across_frames = True)
+
+    # BufferedReader splits lines in C, so iterating costs what a plain file does
+    return io.BufferedReader(DecompressedStream(reader, raw_file), buffer_size)
@@ -0,0 +1,115 @@
+#!/usr/local/bin/python -Wignore::DeprecationWarning
+# -*- coding: utf-8 -*-
+
+import json
+import struct
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+class JSONRowEncoder(object):
+    name = 'json'
+
+    # text format, same bytes as json.dumps(facts).encode('string-escape')
+    copy_options = None
+
+    copy_header = ''
+    copy_trailer = ''
+
+    def encode(self, facts):
+        # json.dumps only emits printable ASCII, on which string-escape does
+        # nothing but escape backslashes and single quotes
+        return json.dumps(facts).replace('\\', '\\\\').replace('\'', '\\\'')
+
+    def copy_row(self, session_id, row):
+        return '\t'.join((str(session_id), row,)) + '\n'
+
+class UJSONRowEncoder(JSONRowEncoder):
+    name = 'ujson'
+
+    # ASCII-only JSON never contains a raw tab, newline or \x01, so in csv
+    # format with those as delimiter and quote it needs no escaping at all
+    copy_options = "(format csv, delimiter E'\\t', quote E'\\x01')"
+
+    def __init__(self):
+        self.options = {'ensure_ascii': True, 'escape_forward_slashes': False}
+
+        # ujson 1.x rounds floats to 10 digits unless told otherwise, 2.x
+        # always emits the shortest repr and dropped the option
+        try:
+            ujson.dumps(0.5, double_precision = 15)
+        except TypeError:
+            pass
+        else:
+            self.options['double_precision'] = 15
+
+    def encode(self, facts):
+        return ujson.dumps(facts, **self.options)
+
+class BinaryRowEncoder(object):
+    copy_options = '(format binary)'
+
+    copy_header = 'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+    copy_trailer = struct.pack('>h', -1)
+
+    session_id_types = {'integer': 'i', 'bigint': 'q'}
+    row_types = ('json', 'jsonb',)
+
+    def __init__(self, name = 'auto'):
+        # rows go out unescaped, so any backend emitting ASCII-only JSON will do
+        if name == 'auto':
+            name = 'ujson' if ujson is not None else 'json'
+
+        self.name = name
+
+        if name == 'ujson':
+            self.dumps = UJSONRowEncoder().encode
+        else:
+            self.dumps = json.dumps
+
+        self.set_columns('integer', 'jsonb')
+
+    def set_columns(self, session_id_type, row_type):
+        if session_id_type not in self.session_id_types or row_type not in self.row_types:
+            raise TypeError('binary COPY needs (integer or bigint, json or jsonb) columns, not (%s, %s)' % (session_id_type, row_type,))
+
+        session_id_format = self.session_id_types[session_id_type]
+
+        self.tuple_header = struct.Struct('>hi%si' % (session_id_format,))
+        self.session_id_size = struct.calcsize('>' + session_id_format)
+
+        # jsonb binary input is a version byte followed by the JSON text
+        self.row_prefix = '\x01' if row_type == 'jsonb' else ''
+
+    def encode(self, facts):
+        return self.dumps(facts)
+
+    def copy_row(self, session_id, row):
+        row = self.row_prefix + row
+
+        return self.tuple_header.pack(2, self.session_id_size, session_id, len(row)) + row
+
+row_encoders =  { \
+                    'json':     JSONRowEncoder, \
+                    'ujson':    UJSONRowEncoder, \
+                }
+
+def make_row_encoder(name = 'auto', binary = False):
+    if binary:
+        if name == 'ujson' and ujson is None:
+            raise ValueError('row encoder ujson is not installed')
+
+        return BinaryRowEncoder(name)
+
+    if name == 'auto':
+        name = 'ujson' if ujson is not None else 'json'
+
+    if name not in row_encoders:
+        raise ValueError('unknown row encoder %s' % (name,))
+
+    if name == 'ujson' and ujson is None:
+        raise ValueError('row encoder ujson is not installed')
+
+    return row_encoders[name]()
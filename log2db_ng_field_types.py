@@ -5,129 +5,426 @@ import re
 import urllib
 import urlparse
 import math
+import collections
+import itertools
 
+import os
+
+import maxminddb
 import geoip2.database
 import geoip2.errors
 
-geoip_city = geoip2.database.Reader('/usr/local/share/GeoIP/GeoIP2-City.mmdb') 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+geoip_modes =   { \
+                    'auto':     maxminddb.MODE_AUTO, \
+                    'c':        maxminddb.MODE_MMAP_EXT, \
+                    'mmap':     maxminddb.MODE_MMAP, \
+                    'memory':   maxminddb.MODE_MEMORY, \
+                    'file':     maxminddb.MODE_FILE, \
+                }
+
+geoip_city_path = '/usr/local/share/GeoIP/GeoIP2-City.mmdb'
+geoip_city_mode = 'auto'
+
+geoip_city = None
+geoip_city_pid = None
+
+def configure_geoip(path = None, mode = None):
+    global geoip_city_path, geoip_city_mode
+
+    if mode is not None and mode not in geoip_modes:
+        raise ValueError('unknown geoip mode %s' % (mode,))
+
+    close_geoip()
+
+    geoip_city_path = path or geoip_city_path
+    geoip_city_mode = mode or geoip_city_mode
+
+def open_geoip():
+    global geoip_city, geoip_city_pid
+
+    # mmap and memory readers opened before a fork are shared with the
+    # children; a plain file reader would share its file offset, so it is
+    # reopened per process
+    if geoip_city is None or (geoip_city_mode == 'file' and geoip_city_pid != os.getpid()):
+        geoip_city = geoip2.database.Reader(geoip_city_path, mode = geoip_modes[geoip_city_mode])
+        geoip_city_pid = os.getpid()
+
+    return geoip_city
+
+def close_geoip():
+    global geoip_city, geoip_city_pid
+
+    if geoip_city is not None and geoip_city_pid == os.getpid():
+        geoip_city.close()
+
+    geoip_city = None
+    geoip_city_pid = None
+
+def instance_cleaner(field_class):
+    return lambda value: field_class(value).clean()
+
+# a column cleaner takes the raw values of one field for a chunk of rows and
+# returns the cleaned values, None where a value failed, and the indexes of
+# the failed ones
+
+def value_column_cleaner(cleaner):
+    def clean_column(values):
+        res = []
+        failed = []
+
+        for i, value in enumerate(values):
+            try:
+                res.append(cleaner(value))
+            except Exception:
+                res.append(None)
+                failed.append(i)
+
+        return res, failed
+
+    return clean_column
+
+def scalar_column_cleaner(field_class):
+    return value_column_cleaner(field_class.compile_cleaner())
+
+def bulk_column_cleaner(bulk_cleaner, cleaner):
+    clean_scalar = value_column_cleaner(cleaner)
+
+    def clean_column(values):
+        try:
+            return bulk_cleaner(values), []
+        except Exception:
+            # some value is bad, only the scalar path can tell which
+            return clean_scalar(values)
+
+    return clean_column
+
+class LogFieldType(type):
+    def __init__(cls, name, bases, attrs):
+        super(LogFieldType, cls).__init__(name, bases, attrs)
+
+        # a class that overrides clean() without saying how to clean a bare
+        # value is only usable as a trait through an instance of itself
+        if 'clean' in attrs and 'compile_cleaner' not in attrs:
+            cls.compile_cleaner = classmethod(instance_cleaner)
+
+        if 'clean' in attrs and 'compile_column_cleaner' not in attrs:
+            cls.compile_column_cleaner = classmethod(scalar_column_cleaner)
+
+        cls.compile()
 
 class LogField(object):
+    __metaclass__ = LogFieldType
+
     def __init__(self, value, *args, **kwargs):
         self.value = value
 
         super(LogField, self).__init__(*args, **kwargs)
 
+    @classmethod
+    def compile(cls):
+        pass
+
+    @classmethod
+    def compile_cleaner(cls):
+        return lambda value: value
+
+    @classmethod
+    def compile_column_cleaner(cls):
+        return scalar_column_cleaner(cls)
+
     def clean(self):
         return self.value
 
+# every spelling of 0-255 the old dotted-quad regexp accepted, leading zeros included
+ipv4_octets = frozenset('%0*d' % (width, i) for i in xrange(256) for width in (1, 2, 3,) if len(str(i)) <= width)
+
+def clean_ipv4(value):
+    octets = value.split('.', 4)
+
+    assert len(octets) >= 4 and octets[0] in ipv4_octets and octets[1] in ipv4_octets and octets[2] in ipv4_octets and octets[3] in ipv4_octets
+
+    return value
+
 class IPv4Field(LogField):
-    def clean(self):
-        assert re.match('([0-2]?([0-5]|(?<![2-9])[0-9])?([0-5]|(?<!25)[0-9])\.){4}', self.value + '.')
+    @classmethod
+    def compile_cleaner(cls):
+        return clean_ipv4
 
-        return self.value
+    def clean(self):
+        return clean_ipv4(self.value)
     
+class LRUCache(object):
+    def __init__(self, size, weight = None):
+        self.size = size
+        self.weight = weight or (lambda key, value: 1)
+        self.items = collections.OrderedDict()
+        self.total = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default = None):
+        try:
+            item = self.items.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+
+        self.items[key] = item
+        self.hits += 1
+
+        return item[0]
+
+    def set(self, key, value):
+        weight = self.weight(key, value)
+
+        if weight > self.size:
+            return
+
+        if key in self.items:
+            self.total -= self.items.pop(key)[1]
+
+        self.items[key] = (value, weight,)
+        self.total += weight
+
+        self.evict()
+
+    def evict(self):
+        while self.total > self.size and self.items:
+            self.total -= self.items.popitem(last = False)[1][1]
+
+    def resize(self, size):
+        self.size = size
+
+        self.evict()
+
+    def stats(self):
+        return {'size': len(self.items), 'total': self.total, 'hits': self.hits, 'misses': self.misses}
+
+def geoip2_city(db):
+    try:
+        return  { \
+                    'id':       db.city.geoname_id, \
+                    'title':    db.city.names['en'] if 'en' in db.city.names else None, \
+                    'title_ru': db.city.names['ru'] if 'ru' in db.city.names else None, \
+                }
+    except:
+        return ''
+
+def geoip2_region(db):
+    try:
+        return  { \
+                    'id':       db.subdivisions[0].geoname_id, \
+                    'iso_code': db.subdivisions[0].iso_code, \
+                    'title':    db.subdivisions[0].names['en'] if 'en' in db.subdivisions[0].names else None, \
+                    'title_ru': db.subdivisions[0].names['ru'] if 'ru' in db.subdivisions[0].names else None, \
+                }
+    except:
+        return ''
+
+def geoip2_country(db):
+    try:
+        return  { \
+                    'id':       db.country.geoname_id, \
+                    'iso_code': db.country.iso_code, \
+                    'title':    db.country.names['en'] if 'en' in db.country.names else None, \
+                    'title_ru': db.country.names['ru'] if 'ru' in db.country.names else None, \
+                }
+    except:
+        return ''
+
 class GeoIP2CityDBField(IPv4Field):
-    db = None
-    ip = None
+    cache = LRUCache(65536)
 
     def __init__(self, value, *args, **kwargs):
         super(GeoIP2CityDBField, self).__init__(value, *args, **kwargs)
 
+    @staticmethod
+    def lookup(ip):
+        try:
+            db = open_geoip().city(ip)
+        except geoip2.errors.AddressNotFoundError:
+            db = None
+
+        return  { \
+                    'city':     geoip2_city(db), \
+                    'region':   geoip2_region(db), \
+                    'country':  geoip2_country(db), \
+                }
+
     def clean(self):
         self.value = super(GeoIP2CityDBField, self).clean()
 
-        if self.ip != self.value:
-            try:
-                GeoIP2CityDBField.db = geoip_city.city(self.value)
-            except geoip2.errors.AddressNotFoundError:
-                GeoIP2CityDBField.db = None
+        self.record = self.cache.get(self.value)
 
-            GeoIP2CityDBField.ip = self.value
+        if self.record is None:
+            self.record = self.lookup(self.value)
+            self.cache.set(self.value, self.record)
 
 class GeoIP2CityDBCityField(GeoIP2CityDBField):
     def clean(self):
-        self.value = super(GeoIP2CityDBCityField, self).clean()
+        super(GeoIP2CityDBCityField, self).clean()
 
-        try:
-            return  { \
-                        'id':       self.db.city.geoname_id, \
-                        'title':    self.db.city.names['en'] if 'en' in self.db.city.names else None, \
-                        'title_ru': self.db.city.names['ru'] if 'ru' in self.db.city.names else None, \
-                    }
-        except:
-            return ''
+        return self.record['city']
 
 class GeoIP2CityDBRegionField(GeoIP2CityDBField):
     def clean(self):
-        self.value = super(GeoIP2CityDBRegionField, self).clean()
+        super(GeoIP2CityDBRegionField, self).clean()
 
-        try:
-            return  { \
-                        'id':       self.db.subdivisions[0].geoname_id, \
-                        'iso_code': self.db.subdivisions[0].iso_code, \
-                        'title':    self.db.subdivisions[0].names['en'] if 'en' in self.db.subdivisions[0].names else None, \
-                        'title_ru': self.db.subdivisions[0].names['ru'] if 'ru' in self.db.subdivisions[0].names else None, \
-                    }
-        except:
-            return ''
+        return self.record['region']
 
 class GeoIP2CityDBCountryField(GeoIP2CityDBField):
     def clean(self):
-        self.value = super(GeoIP2CityDBCountryField, self).clean()
+        super(GeoIP2CityDBCountryField, self).clean()
 
-        try:
-            return  { \
-                        'id':       self.db.country.geoname_id, \
-                        'iso_code': self.db.country.iso_code, \
-                        'title':    self.db.country.names['en'] if 'en' in self.db.country.names else None, \
-                        'title_ru': self.db.country.names['ru'] if 'ru' in self.db.country.names else None, \
-                    }
-        except:
-            return ''
+        return self.record['country']
+
+def clean_int(value):
+    if isinstance(value, basestring):
+        if len(value) == 0:
+            return None
+
+    return int(value)
+
+def clean_int_column(values):
+    return [int(value) if value != '' else None for value in values]
 
 class IntField(LogField):
+    @classmethod
+    def compile_cleaner(cls):
+        return clean_int
+
+    @classmethod
+    def compile_column_cleaner(cls):
+        return bulk_column_cleaner(clean_int_column, clean_int)
+
     def clean(self):
-        if isinstance(self.value, basestring):
-            if len(self.value) == 0:
-                return None
+        return clean_int(self.value)
+
+def clean_float(value):
+    if isinstance(value, basestring):
+        if len(value) == 0:
+            return None
+
+    res = float(value)
+    if math.isnan(res):
+        return None
+    if math.isinf(res):
+        return None
+
+    return res
+
+float_nan = float('nan')
+float_inf = float('inf')
 
-        return int(self.value)
+def clean_float_column(values):
+    if '' in values:
+        values = [value if value != '' else float_nan for value in values]
+
+    if numpy is None:
+        res = map(float, values)
+
+        # NaN fails both comparisons
+        return [value if -float_inf < value < float_inf else None for value in res]
+
+    # an object array converts through float() itself, so it accepts and
+    # rejects exactly what the scalar path does
+    res = numpy.array(values, dtype = object).astype(numpy.float64)
+    finite = numpy.isfinite(res)
+
+    res = res.tolist()
+
+    if not finite.all():
+        for i in numpy.flatnonzero(~finite).tolist():
+            res[i] = None
+
+    return res
 
 class FloatField(LogField):
+    @classmethod
+    def compile_cleaner(cls):
+        return clean_float
+
+    @classmethod
+    def compile_column_cleaner(cls):
+        return bulk_column_cleaner(clean_float_column, clean_float)
+
     def clean(self):
-        if isinstance(self.value, basestring):
-            if len(self.value) == 0:
-                return None
+        return clean_float(self.value)
 
-        res = float(self.value)
-        if math.isnan(res):
-            return None
-        if math.isinf(res):
+def clean_nullable(value):
+    if isinstance(value, basestring):
+        if value.lower() == 'undefined':
             return None
 
-        return res
- 
+    return value
+
 class NullableField(LogField):
+    @classmethod
+    def compile_cleaner(cls):
+        return clean_nullable
+
+    @classmethod
+    def compile_column_cleaner(cls):
+        return bulk_column_cleaner(lambda values: map(clean_nullable, values), clean_nullable)
+
     def clean(self):
-        if isinstance(self.value, basestring):
-            if self.value.lower() == 'undefined':
-                return None
+        return clean_nullable(self.value)
 
-        return self.value
+def clean_escaped(value):
+    return value.encode('string-escape')
 
 class EscapedField(LogField):
+    @classmethod
+    def compile_cleaner(cls):
+        return clean_escaped
+
     def clean(self):
-        return self.value.encode('string-escape') 
+        return clean_escaped(self.value)
+
+def clean_multi_line(value):
+    return ''.join(value.splitlines())
 
 class MultiLineField(LogField):
+    @classmethod
+    def compile_cleaner(cls):
+        return clean_multi_line
+
     def clean(self):
-        return ''.join(self.value.splitlines())
+        return clean_multi_line(self.value)
+
+def clean_url_decoded(value):
+    return urllib.unquote(value).decode('utf8', 'replace').encode('utf8')
 
 class URLDecodedField(LogField):
+    @classmethod
+    def compile_cleaner(cls):
+        return clean_url_decoded
+
     def clean(self):
-        return urllib.unquote(self.value).decode('utf8', 'replace').encode('utf8')
+        return clean_url_decoded(self.value)
 
 class RecursiveField(LogField):
+    @classmethod
+    def compile_cleaner(cls):
+        field_cleaner = cls.field_class.compile_cleaner()
+
+        def clean_recursive(value):
+            while True:
+                action_value = field_cleaner(value)
+
+                if value == action_value:
+                    return value
+
+                value = action_value
+
+        return clean_recursive
+
     def clean(self):
         action_value = self.field_class(self.value).clean()
 
@@ -138,45 +435,148 @@ class RecursiveField(LogField):
         
         return self.clean() 
 
-def RecursiveFieldType(field_class):
-    res = RecursiveField 
-    res.field_class = field_class 
+# the factories return one memoized subclass per argument instead of patching
+# the shared class, so chains compiled from them cannot change afterwards
+field_type_cache = {}
 
-    return res
+def field_subclass(base_class, **attrs):
+    key = (base_class,) + tuple(sorted(attrs.iteritems()))
+
+    if key not in field_type_cache:
+        field_type_cache[key] = type(base_class)(base_class.__name__, (base_class,), attrs)
+
+    return field_type_cache[key]
+
+def RecursiveFieldType(field_class):
+    return field_subclass(RecursiveField, field_class = field_class)
 
 class RegexpField(LogField):
+    @classmethod
+    def compile_cleaner(cls):
+        regexp = cls.regexp
+
+        def clean_regexp(value):
+            assert regexp.match(value)
+
+            return value
+
+        return clean_regexp
+
     def clean(self):
-        assert re.match(self.regexp, self.value)
+        assert self.regexp.match(self.value)
 
         return self.value
 
+def clean_lower(value):
+    return value.lower()
+
 class LowerField(LogField):
+    @classmethod
+    def compile_cleaner(cls):
+        return clean_lower
+
     def clean(self):
-        return self.value.lower()
+        return clean_lower(self.value)
 
 
 def LimitedLengthFieldType(length_limit):
-    res = LimitedLengthField
-    res.length_limit = length_limit
-
-    return res
+    return field_subclass(LimitedLengthField, length_limit = length_limit)
 
 class LimitedLengthField(LogField):
+    @classmethod
+    def compile_cleaner(cls):
+        length_limit = cls.length_limit
+
+        return lambda value: value[:length_limit]
+
     def clean(self):
         return self.value[:self.length_limit]
 
+def chain_cleaners(cleaners):
+    def clean_chain(value):
+        for cleaner in cleaners:
+            value = cleaner(value)
+            if value is None:
+                return value
+
+        return value
+
+    return clean_chain
+
+def chain_column_cleaners(column_cleaners):
+    def clean_column_chain(values):
+        res = list(values)
+        rows = range(len(res))
+        failed = []
+
+        for column_cleaner in column_cleaners:
+            column, column_failed = column_cleaner([res[i] for i in rows])
+
+            failed.extend(rows[i] for i in column_failed)
+
+            for i, value in itertools.izip(rows, column):
+                res[i] = value
+
+            # like the scalar chain, a None (failed ones included) stops here
+            rows = [i for i in rows if res[i] is not None]
+
+        return res, sorted(failed)
+
+    return clean_column_chain
+
 class MultiTraitField(LogField):
+    is_trait_chain = True
+
+    traits_cleaner = staticmethod(lambda value: value)
+    traits_column_cleaner = staticmethod(lambda values: (list(values), [],))
+
+    @classmethod
+    def compile(cls):
+        # only classes mixing MultiTraitField in directly define a chain, their
+        # subclasses (ErrorFieldType() ones for instance) inherit it
+        if not any(vars(base).get('is_trait_chain') for base in cls.__bases__):
+            return
+
+        cls.traits_cleaner = staticmethod(chain_cleaners([base.compile_cleaner() for base in cls.__bases__ if not vars(base).get('is_trait_chain')]))
+        cls.traits_column_cleaner = staticmethod(chain_column_cleaners([base.compile_column_cleaner() for base in cls.__bases__ if not vars(base).get('is_trait_chain')]))
+
+    @classmethod
+    def compile_cleaner(cls):
+        return cls.traits_cleaner
+
+    @classmethod
+    def compile_column_cleaner(cls):
+        return cls.traits_column_cleaner
+
     def clean(self):
-        for base_class in type(self).__bases__:
-            if base_class != MultiTraitField:
-                self.value = base_class(self.value).clean()
-                if self.value is None:
-                    return self.value
+        self.value = self.traits_cleaner(self.value)
 
         return self.value
 
+hex_digits = '0123456789abcdefABCDEF'
+
+guid_regexp = re.compile('(?i)[0-9a-f]{8}-?([0-9a-f]{4}-?){3}[0-9a-f]{12}')
+
+def clean_guid(value):
+    if len(value) >= 32 and not value[:32].translate(None, hex_digits):
+        return value
+
+    if len(value) >= 36 and value[8] == value[13] == value[18] == value[23] == '-' and not (value[:8] + value[9:13] + value[14:18] + value[19:23] + value[24:36]).translate(None, hex_digits):
+        return value
+
+    assert guid_regexp.match(value)
+
+    return value
+
 class GUIDField(RegexpField):
-    regexp = '(?i)[0-9a-f]{8}-?([0-9a-f]{4}-?){3}[0-9a-f]{12}'
+    regexp = guid_regexp
+
+    @classmethod
+    def compile_cleaner(cls):
+        return clean_guid
+
+    def clean(self):
+        return clean_guid(self.value)
 
 class LogGUIDField(MultiTraitField, NullableField, GUIDField, LowerField):
     pass
@@ -190,8 +590,33 @@ class LogCharField(MultiTraitField, NullableField, RecursiveFieldType(URLDecoded
 class TimestampField(MultiTraitField, FloatField, IntField):
     pass
 
+# rough per entry bookkeeping cost on top of the string lengths
+cache_entry_overhead = 256
+
 class RefererField(MultiTraitField, RecursiveFieldType(URLDecodedField), EscapedField, LimitedLengthFieldType(1024)):
+    # parts are cached as a tuple and the dict is rebuilt per row, so rows never
+    # share it and its key order (and with it the JSON) stays the same
+    cache = LRUCache(16 * 1024 * 1024, lambda key, value: cache_entry_overhead + len(key) + sum(len(i) for i in value))
+
     def clean(self):
+        # split() leaves the cleaned value behind, the raw one is the key
+        key = self.value
+        parts = self.cache.get(key)
+
+        if parts is None:
+            parts = self.split()
+            self.cache.set(key, parts)
+
+        return  { \
+                    'scheme':   parts[0], \
+                    'netloc':   parts[1], \
+                    'colten':   parts[2], \
+                    'path':     parts[3], \
+                    'query':    parts[4], \
+                    'site':     parts[5], \
+                }
+
+    def split(self):
         super(RefererField, self).clean()
 
         o = urlparse.urlsplit(self.value)
@@ -201,20 +626,17 @@ class RefererField(MultiTraitField, RecursiveFieldType(URLDecodedField), Escaped
 
         hostname = o.hostname or ''
 
-        return  { \
-                    'scheme':   o.scheme, \
-                    'netloc':   hostname, \
-                    'colten':   '.'.join(reversed(hostname.split('.'))), \
-                    'path':     o.path, \
-                    'query':    o.query, \
-                    'site':     '.'.join(hostname.split('.')[-2:]), \
-                }
+        return  ( \
+                    o.scheme, \
+                    hostname, \
+                    '.'.join(reversed(hostname.split('.'))), \
+                    o.path, \
+                    o.query, \
+                    '.'.join(hostname.split('.')[-2:]), \
+                )
 
 def ErrorFieldType(error_type):
-    res = ErrorField
-    res.error_type = error_type
-
-    return res
+    return field_subclass(ErrorField, error_type = error_type)
 
 class ErrorField(MultiTraitField, RecursiveFieldType(URLDecodedField), EscapedField):
     def clean(self):
@@ -223,7 +645,7 @@ class ErrorField(MultiTraitField, RecursiveFieldType(URLDecodedField), EscapedFi
         res = {}
         res['name'] = self.error_type
 
-        field_parts = re.split('[,]', self.value)
+        field_parts = self.value.split(',')
 
         try:
             res['code'] = int(field_parts[0])
@@ -234,4 +656,27 @@ class ErrorField(MultiTraitField, RecursiveFieldType(URLDecodedField), EscapedFi
         return res
 
 class UserAgentField(MultiTraitField, URLDecodedField, EscapedField, LimitedLengthFieldType(1024)):
-    pass
+    cache = LRUCache(16 * 1024 * 1024, lambda key, value: cache_entry_overhead + len(key) + len(value))
+
+    def clean(self):
+        res = self.cache.get(self.value)
+
+        if res is None:
+            res = self.traits_cleaner(self.value)
+            self.cache.set(self.value, res)
+
+        self.value = res
+
+        return res
+
+field_caches =  { \
+                    'geoip':        GeoIP2CityDBField.cache, \
+                    'referer':      RefererField.cache, \
+                    'user_agent':   UserAgentField.cache, \
+                }
+
+def cache_stats():
+    return {name: (cache.hits, cache.misses,) for name, cache in field_caches.iteritems()}
+
+def cache_stats_since(start):
+    return {name: (hits - start[name][0], misses - start[name][1],) for name, (hits, misses) in cache_stats().iteritems()}
@@ -0,0 +1,152 @@
+#!/usr/local/bin/python -Wignore::DeprecationWarning
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import os
+import json
+import threading
+import collections
+
+from timeit import default_timer as timer
+
+class StageMetrics(object):
+    def __init__(self):
+        self.counters = collections.defaultdict(int)
+        self.stage_seconds = collections.defaultdict(float)
+        self.stage_calls = collections.defaultdict(int)
+        self.field_seconds = collections.defaultdict(float)
+        self.field_calls = collections.defaultdict(int)
+        self.field_errors = collections.defaultdict(int)
+
+    def add(self, stage, seconds, calls = 1):
+        self.stage_seconds[stage] += seconds
+        self.stage_calls[stage] += calls
+
+    def error(self, field_type):
+        self.field_errors[field_type] += 1
+
+    def timed(self, stage, func):
+        def timed_func(*args, **kwargs):
+            start = timer()
+
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(stage, timer() - start)
+
+        return timed_func
+
+    def timed_iter(self, stage, items):
+        items = iter(items)
+
+        while True:
+            start = timer()
+
+            try:
+                item = next(items)
+            except StopIteration:
+                self.add(stage, timer() - start, 0)
+                return
+
+            self.add(stage, timer() - start)
+
+            yield item
+
+    def timed_column(self, field_type, column_cleaner):
+        def timed_column_cleaner(values):
+            start = timer()
+
+            try:
+                return column_cleaner(values)
+            finally:
+                seconds = timer() - start
+
+                self.add('clean', seconds, len(values))
+                self.field_seconds[field_type] += seconds
+                self.field_calls[field_type] += len(values)
+
+        return timed_column_cleaner
+
+    def clean_facts(self, facts):
+        res = {}
+
+        for k, v in facts.iteritems():
+            start = timer()
+            res[k] = v.clean()
+
+            field_type = v.__class__.__name__
+            self.field_seconds[field_type] += timer() - start
+            self.field_calls[field_type] += 1
+
+        return res
+
+    def state(self):
+        return tuple(dict(i) for i in (self.counters, self.stage_seconds, self.stage_calls, self.field_seconds, self.field_calls, self.field_errors,))
+
+    def merge(self, state):
+        for totals, values in zip((self.counters, self.stage_seconds, self.stage_calls, self.field_seconds, self.field_calls, self.field_errors,), state):
+            for k, v in values.iteritems():
+                totals[k] += v
+
+    def summary(self):
+        return  { \
+                    'stages':   {stage: {'seconds': round(seconds, 6), 'calls': self.stage_calls[stage]} for stage, seconds in self.stage_seconds.iteritems()}, \
+                    'fields':   {field_type: {'seconds': round(seconds, 6), 'calls': self.field_calls[field_type]} for field_type, seconds in self.field_seconds.iteritems()}, \
+                    'errors':   dict(self.field_errors), \
+                }
+
+def prometheus_label(value):
+    return '"%s"' % (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'),)
+
+def prometheus_text(metrics, labels):
+    lines = []
+
+    def metric(name, kind, values, label_name = None):
+        lines.append('# TYPE log2db_ng_%s %s' % (name, kind,))
+
+        for key, value in sorted(values.iteritems()):
+            metric_labels = dict(labels)
+            if label_name:
+                metric_labels[label_name] = key
+
+            lines.append('log2db_ng_%s{%s} %r' % (name, ','.join('%s=%s' % (k, prometheus_label(v),) for k, v in sorted(metric_labels.iteritems())), value,))
+
+    for counter, value in sorted(metrics.counters.iteritems()):
+        metric('%s_total' % (counter,), 'counter', {None: value})
+
+    metric('stage_seconds_total', 'counter', metrics.stage_seconds, 'stage')
+    metric('stage_calls_total', 'counter', metrics.stage_calls, 'stage')
+    metric('field_clean_seconds_total', 'counter', metrics.field_seconds, 'field_type')
+    metric('field_clean_calls_total', 'counter', metrics.field_calls, 'field_type')
+    metric('field_errors_total', 'counter', metrics.field_errors, 'field_type')
+
+    return '\n'.join(lines) + '\n'
+
+class MetricsReport(object):
+    def __init__(self, json_path = None, prometheus_path = None, labels = None):
+        self.json_path = json_path
+        self.prometheus_path = prometheus_path
+        self.labels = labels or {}
+
+        self.totals = StageMetrics()
+        self.lock = threading.Lock()
+
+    def file_done(self, summary, metrics):
+        with self.lock:
+            if self.json_path == '-':
+                print(json.dumps(summary, sort_keys = True))
+            elif self.json_path:
+                with open(self.json_path, 'a') as json_file:
+                    json_file.write(json.dumps(summary, sort_keys = True) + '\n')
+
+            self.totals.merge(metrics.state())
+
+            # written aside and renamed, so a scraper never reads half a file
+            if self.prometheus_path:
+                tmp_path = '%s.%s.tmp' % (self.prometheus_path, os.getpid(),)
+
+                with open(tmp_path, 'w') as prometheus_file:
+                    prometheus_file.write(prometheus_text(self.totals, self.labels))
+
+                os.rename(tmp_path, self.prometheus_path)
@@ -0,0 +1,306 @@
+#!/usr/local/bin/python -Wignore::DeprecationWarning
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import Queue
+import threading
+import traceback
+import multiprocessing
+
+from log2db_ng_compression import open_log_file, is_compressed
+
+class RowStream(object):
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.buffer = ''
+
+    def fill(self, size):
+        chunks = [self.buffer]
+        length = len(self.buffer)
+
+        while size < 0 or length < size:
+            try:
+                chunk = next(self.rows)
+            except StopIteration:
+                break
+
+            chunks.append(chunk)
+            length += len(chunk)
+
+        self.buffer = ''.join(chunks)
+
+    def read(self, size = -1):
+        self.fill(size)
+
+        if size < 0:
+            size = len(self.buffer)
+
+        res, self.buffer = self.buffer[:size], self.buffer[size:]
+
+        return res
+
+    def readline(self, size = -1):
+        while '\n' not in self.buffer:
+            length = len(self.buffer)
+
+            self.fill(length + 1)
+
+            if len(self.buffer) == length:
+                break
+
+        size = self.buffer.find('\n') + 1 or len(self.buffer)
+
+        res, self.buffer = self.buffer[:size], self.buffer[size:]
+
+        return res
+
+def background(items, batch_size = 1000, queue_depth = 16):
+    batches = Queue.Queue(queue_depth)
+    stopped = threading.Event()
+
+    def put(message):
+        while not stopped.is_set():
+            try:
+                batches.put(message, timeout = 1)
+                return
+            except Queue.Full:
+                pass
+
+    def produce():
+        try:
+            batch = []
+
+            for item in items:
+                batch.append(item)
+
+                if len(batch) >= batch_size:
+                    put(('items', batch,))
+                    batch = []
+
+                    if stopped.is_set():
+                        return
+
+            put(('items', batch,))
+            put(('done', None,))
+        except Exception:
+            put(('failed', sys.exc_info(),))
+
+    producer = threading.Thread(target = produce)
+    producer.daemon = True
+    producer.start()
+
+    try:
+        while True:
+            kind, batch = batches.get()
+
+            if kind == 'done':
+                break
+
+            if kind == 'failed':
+                raise batch[0], batch[1], batch[2]
+
+            for item in batch:
+                yield item
+    finally:
+        stopped.set()
+
+    producer.join()
+
+def split_file(filename, chunk_size, start = 0, end = None):
+    size = os.path.getsize(filename) if end is None else end
+
+    # compressed files can only be read from the start
+    if not chunk_size or size - start <= chunk_size or is_compressed(filename):
+        return [(start, end,)]
+
+    ranges = []
+
+    with open(filename, 'r') as log_file:
+        while start < size:
+            log_file.seek(start + chunk_size)
+            log_file.readline()
+
+            chunk_end = min(log_file.tell(), size)
+
+            ranges.append((start, chunk_end,))
+            start = chunk_end
+
+    return ranges
+
+adler32_base = 65521
+
+# zlib's adler32_combine, which the zlib module does not expose: the adler32
+# of a followed by b, from the adler32 of each and the length of b
+def adler32_combine(adler_a, adler_b, length_b):
+    rem = length_b % adler32_base
+
+    sum_a = adler_a & 0xffff
+    sum_b = (rem * sum_a) % adler32_base
+
+    sum_a = (sum_a + (adler_b & 0xffff) + adler32_base - 1) % adler32_base
+    sum_b = (sum_b + ((adler_a >> 16) & 0xffff) + ((adler_b >> 16) & 0xffff) + adler32_base - rem) % adler32_base
+
+    return sum_a | (sum_b << 16)
+
+def complete_lines_end(filename, start, end, block_size = 65536):
+    with open(filename, 'r') as log_file:
+        while end > start:
+            block_start = max(start, end - block_size)
+
+            log_file.seek(block_start)
+            newline = log_file.read(end - block_start).rfind('\n')
+
+            if newline >= 0:
+                return block_start + newline + 1
+
+            end = block_start
+
+    return start
+
+def read_range(log_file, start, end):
+    if start:
+        log_file.seek(start)
+
+    if end is None:
+        for line in log_file:
+            yield line
+
+        return
+
+    position = start
+    while position < end:
+        line = log_file.readline()
+        if not line:
+            break
+
+        position += len(line)
+
+        yield line
+
+def parse_worker(task_queue, result_queue, batch_bytes, process_group = False):
+    # keeps a terminal's ^C or a process group kill away from the workers, so
+    # the parent can still drain the files it has in flight
+    if process_group:
+        os.setpgrp()
+
+    for session_class, data_type, state, filename, start, end in iter(task_queue.get, None):
+        try:
+            session = session_class.detached(filename, data_type, *state)
+
+            batch = {'rows': [], 'errors': [], 'bytes': 0}
+
+            def flush():
+                result_queue.put(('rows', batch['rows'], batch['errors'], session.rows_processed,))
+
+                batch['rows'] = []
+                batch['errors'] = []
+                batch['bytes'] = 0
+
+            def reject(row_number, info, line):
+                batch['errors'].append((row_number, info, line,))
+                batch['bytes'] += len(repr(info)) + len(line)
+
+                if batch['bytes'] >= batch_bytes:
+                    flush()
+
+            with open_log_file(filename) as log_file:
+                for row in session.prepare(read_range(log_file, start, end), reject, lambda: None):
+                    batch['rows'].append(row)
+                    batch['bytes'] += len(row)
+
+                    if batch['bytes'] >= batch_bytes:
+                        flush()
+
+            flush()
+
+            result_queue.put(('done', session.rows_processed, session.rows_prepared, session.cache_stats, session.ts_min, session.ts_max, session.metrics.state(), session.content_hash, session.content_length,))
+        except Exception:
+            result_queue.put(('failed', traceback.format_exc(),))
+
+class ParseWorkerPool(object):
+    def __init__(self, workers, worker_memory = 64 * 1024 * 1024, queue_depth = 16, process_group = False):
+        # a worker holds at most queue_depth queued batches plus the one it is
+        # filling and the one being pickled, so that is what worker_memory covers
+        batch_bytes = max(worker_memory // (queue_depth + 2), 1)
+
+        self.task_queues = []
+        self.result_queues = []
+        self.processes = []
+
+        for _ in xrange(workers):
+            task_queue = multiprocessing.Queue()
+            result_queue = multiprocessing.Queue(queue_depth)
+
+            process = multiprocessing.Process(target = parse_worker, args = (task_queue, result_queue, batch_bytes, process_group,))
+            process.daemon = True
+            process.start()
+
+            self.task_queues.append(task_queue)
+            self.result_queues.append(result_queue)
+            self.processes.append(process)
+
+        self.tasks = 0
+
+        # a worker answers its tasks in order, so the only task whose results
+        # can be read from its queue is the oldest one not finished yet
+        self.next_results = range(workers)
+        self.condition = threading.Condition()
+
+    def submit(self, session_class, data_type, state, filename, start = 0, end = None):
+        with self.condition:
+            index = self.tasks
+
+            self.task_queues[index % len(self.task_queues)].put((session_class, data_type, state, filename, start, end,))
+            self.tasks += 1
+
+        return index
+
+    def finished(self, index):
+        return index < self.next_results[index % len(self.result_queues)]
+
+    def check_worker(self, worker):
+        if not self.processes[worker].is_alive():
+            raise RuntimeError('parse worker %s exited with code %s' % (worker, self.processes[worker].exitcode,))
+
+    def submit_file(self, session_class, data_type, state, filename, chunk_size = None, start = 0, end = None):
+        return [self.submit(session_class, data_type, state, filename, chunk_start, chunk_end) for chunk_start, chunk_end in split_file(filename, chunk_size, start, end)]
+
+    def results(self, index):
+        worker = index % len(self.result_queues)
+        result_queue = self.result_queues[worker]
+
+        with self.condition:
+            while not self.finished(index) and self.next_results[worker] != index:
+                self.check_worker(worker)
+                self.condition.wait(1)
+
+        while not self.finished(index):
+            try:
+                message = result_queue.get(timeout = 1)
+            except Queue.Empty:
+                self.check_worker(worker)
+                continue
+
+            if message[0] != 'rows':
+                with self.condition:
+                    self.next_results[worker] += len(self.result_queues)
+                    self.condition.notify_all()
+
+            yield message
+
+    def file_results(self, indexes):
+        for index in indexes:
+            for message in self.results(index):
+                yield message
+
+    def drain(self, indexes):
+        for _ in self.file_results(indexes):
+            pass
+
+    def close(self):
+        for task_queue in self.task_queues:
+            task_queue.put(None)
+
+        for process in self.processes:
+            process.join()
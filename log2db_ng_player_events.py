@@ -13,12 +13,196 @@ import datetime
 import optparse
 import json
 import tempfile
-import collections
 import traceback
-
+import itertools
+import signal
+import threading
+import Queue
+import zlib
+import hashlib
+import psycopg2.pool
+
+import log2db_ng_field_types
 from log2db_ng_field_types import *
+from log2db_ng_parallel import RowStream, ParseWorkerPool, background, read_range, complete_lines_end, adler32_combine
+from log2db_ng_encoders import make_row_encoder, row_encoders
+from log2db_ng_compression import open_log_file, is_compressed
+from log2db_ng_metrics import StageMetrics, MetricsReport
 
 pgsql_conn = None
+row_encoder = make_row_encoder('json')
+target_table = None
+profile = False
+metrics_report = None
+column_rows = 0
+error_format = 'lines'
+print_errors = 10
+max_error_ratio = 0.0
+mapping_ttl = 60
+skip_values = {}
+
+# the upload_session_field rows of every data_type with the time they were
+# read, and the plans compiled from them
+field_mappings = {}
+field_plans = {}
+
+# the ratio is only judged once this many rows are in, a bad first row
+# should not abort a file
+error_ratio_min_rows = 1000
+
+class ErrorRatioExceeded(RuntimeError):
+    pass
+
+def error_text(value):
+    if isinstance(value, str):
+        return value.decode('utf8', 'replace')
+
+    return value
+
+def resolve_field_type(field_type):
+    try:
+        field_class = eval(field_type, vars(log2db_ng_field_types))
+    except Exception:
+        raise TypeError('unknown field type %s' % (field_type,))
+
+    if not (isinstance(field_class, type) and issubclass(field_class, LogField)):
+        raise TypeError('field type %s is not a LogField' % (field_type,))
+
+    return field_class
+
+field_id_chars = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_-'
+
+def split_field(part):
+    field_id, sep, value = part.partition(':')
+
+    if sep and len(field_id) <= 32 and not field_id.translate(None, field_id_chars):
+        return field_id.lower(), value
+
+    return None
+
+def decode_value(value):
+    if '%' in value:
+        return URLDecodedField(value).clean()
+
+    try:
+        value.decode('utf8')
+    except UnicodeDecodeError:
+        return value.decode('utf8', 'replace').encode('utf8')
+
+    return value
+
+def tokenize_line(line, anonymous_fields):
+    parts = line.split('|')
+
+    keyed_fields = {}
+    for part in parts:
+        field = split_field(part)
+        if field:
+            keyed_fields[field[0]] = field[1]
+
+    # copied once more so that iteration order, and with it the winner among
+    # keys smuggled in through encoded '|', is the same as the regex parser's
+    raw_fields = dict(keyed_fields)
+    raw_fields.update(zip(anonymous_fields, parts))
+
+    fields = {}
+    for k,v in raw_fields.iteritems():
+        v = decode_value(v)
+
+        if '|' not in v:
+            fields[k] = v
+            continue
+
+        decoded_parts = v.split('|')
+        fields[k] = decoded_parts[0]
+
+        for part in decoded_parts[1:]:
+            field = split_field(part)
+            if field:
+                fields[field[0]] = field[1]
+
+    return fields
+
+def smuggles_fields(value):
+    return any(split_field(part) for part in value.split('|')[1:])
+
+def carries_fields(value):
+    return ('%7C' in value or '%7c' in value) and smuggles_fields(decode_value(value))
+
+def tokenize_fields(line, anonymous_fields, wanted_fields):
+    parts = line.split('|')
+
+    # keys smuggled in through an encoded '|' may land on wanted ones, in an
+    # order only the full tokenizer reproduces, so such lines go through it
+    raw_fields = {}
+    for part in parts:
+        field_id, sep, value = part.partition(':')
+
+        if not sep:
+            continue
+
+        key = field_id.lower()
+
+        if key in wanted_fields:
+            if len(field_id) <= 32 and not field_id.translate(None, field_id_chars):
+                raw_fields[key] = value
+        elif carries_fields(value):
+            return tokenize_line(line, anonymous_fields)
+
+    for k, v in zip(anonymous_fields, parts):
+        if k in wanted_fields:
+            raw_fields[k] = v
+        elif carries_fields(v):
+            return tokenize_line(line, anonymous_fields)
+
+    fields = {}
+    for k,v in raw_fields.iteritems():
+        v = decode_value(v)
+
+        if '|' in v:
+            if smuggles_fields(v):
+                return tokenize_line(line, anonymous_fields)
+
+            v = v[:v.index('|')]
+
+        fields[k] = v
+
+    return fields
+
+def clean_facts(facts):
+    return {k:v.clean() for k,v in facts.iteritems()}
+
+def compile_field_plan(fields):
+    return [(field_from, field_to, resolve_field_type(field_type), bool(is_mandatory)) for field_from, field_to, field_type, is_mandatory in fields]
+
+def target_columns(conn, table):
+    cursor = conn.cursor()
+
+    cursor.execute  ( \
+                        ' \
+                            select \
+                                format_type(atttypid, atttypmod) \
+                            from \
+                                pg_attribute \
+                            where \
+                                attrelid = %s::regclass and \
+                                attnum > 0 and \
+                                not attisdropped \
+                            order by \
+                                attnum \
+                        ', \
+                        ( \
+                            table, \
+                        ) \
+                    )
+
+    columns = [column for column, in cursor.fetchall()]
+    cursor.close()
+
+    if len(columns) != 2:
+        raise TypeError('target table %s must have exactly (session_id, row) columns' % (table,))
+
+    return columns
 
 def parse_args():
     usage = "usage: %prog [options] [file1, file2, ...]"
@@ -42,7 +226,7 @@ def parse_args():
                 type    = "string", 
                 dest    = "mask", 
                 default = "*.yastng.*.log",
-                help    = "wildcard for log files")
+                help    = "comma separated wildcards for log files, .gz and .zst files are decompressed on the fly")
 
     parser.add_option("-i", "--limit", 
                 type    = "string", 
@@ -50,6 +234,172 @@ def parse_args():
                 default = 2000,
                 help    = "mask match limit")
 
+    parser.add_option("-w", "--workers", 
+                type    = "int", 
+                dest    = "workers",
+                default = 0,
+                help    = "parse files in N worker processes")
+
+    parser.add_option("-C", "--chunk-size", 
+                type    = "int", 
+                dest    = "chunk_size",
+                default = 0,
+                help    = "split files into chunks of N MB parsed in parallel by the workers")
+
+    parser.add_option("-W", "--worker-memory", 
+                type    = "int", 
+                dest    = "worker_memory",
+                default = 64,
+                help    = "MB of prepared rows a worker may buffer ahead of the loader")
+
+    parser.add_option("-S", "--stream", 
+                action  = "store_true", 
+                dest    = "stream",
+                default = False,
+                help    = "feed COPY while parsing instead of spooling rows to a temporary file")
+
+    parser.add_option("-g", "--geoip-db", 
+                type    = "string", 
+                dest    = "geoip_db",
+                default = log2db_ng_field_types.geoip_city_path,
+                help    = "path to GeoIP2 City mmdb")
+
+    parser.add_option("-M", "--geoip-mode", 
+                type    = "choice", 
+                dest    = "geoip_mode",
+                choices = sorted(log2db_ng_field_types.geoip_modes.keys()),
+                default = "auto",
+                help    = "GeoIP2 reader mode: auto, c, mmap, memory or file")
+
+    parser.add_option("-G", "--geoip-cache", 
+                type    = "int", 
+                dest    = "geoip_cache",
+                default = 65536,
+                help    = "number of IPs kept in the GeoIP lookup cache")
+
+    parser.add_option("-R", "--value-cache", 
+                type    = "int", 
+                dest    = "value_cache",
+                default = 16,
+                help    = "MB of parsed referer and user agent values cached, each")
+
+    parser.add_option("-E", "--row-encoder", 
+                type    = "choice", 
+                dest    = "row_encoder",
+                choices = ['auto'] + sorted(row_encoders.keys()),
+                default = "auto",
+                help    = "row JSON encoder: auto, json or ujson")
+
+    parser.add_option("-T", "--target-table", 
+                type    = "string", 
+                dest    = "target_table",
+                default = None,
+                help    = "binary COPY rows into this (session_id, jsonb row) table instead of per-session tables")
+
+    parser.add_option("-b", "--batch-size", 
+                type    = "int", 
+                dest    = "batch_size",
+                default = 0,
+                help    = "with --target-table, load files in batches of up to N MB with one COPY and one commit")
+
+    parser.add_option("-F", "--follow", 
+                action  = "store_true", 
+                dest    = "follow",
+                default = False,
+                help    = "load only complete lines appended since the last checkpoint and keep the files")
+
+    parser.add_option("-x", "--follow-max", 
+                type    = "int", 
+                dest    = "follow_max",
+                default = 0,
+                help    = "with --follow, load at most N MB of each file per run")
+
+    parser.add_option("-f", "--force-reload", 
+                action  = "store_true", 
+                dest    = "force_reload",
+                default = False,
+                help    = "load files even if one with the same content was loaded before, and leave the fingerprint columns of upload_session alone")
+
+    parser.add_option("-D", "--daemon", 
+                action  = "store_true", 
+                dest    = "daemon",
+                default = False,
+                help    = "keep watching --dir for new files until SIGTERM, parsing in at least one worker")
+
+    parser.add_option("-I", "--poll-interval", 
+                type    = "float", 
+                dest    = "poll_interval",
+                default = 5.0,
+                help    = "with --daemon, seconds between scans of --dir")
+
+    parser.add_option("-L", "--loaders", 
+                type    = "int", 
+                dest    = "loaders",
+                default = 2,
+                help    = "with --daemon, files loaded at once, each over its own db connection")
+
+    parser.add_option("-Q", "--queue-depth", 
+                type    = "int", 
+                dest    = "queue_depth",
+                default = 16,
+                help    = "with --daemon, files queued ahead of the loaders")
+
+    parser.add_option("-p", "--profile", 
+                action  = "store_true", 
+                dest    = "profile",
+                default = False,
+                help    = "time the read, tokenize, clean (per field type) and serialize stages of every row")
+
+    parser.add_option("-K", "--column-rows", 
+                type    = "int", 
+                dest    = "column_rows",
+                default = 0,
+                help    = "clean fields a column of this many rows at a time, 0 cleans row by row")
+
+    parser.add_option("-e", "--error-format", 
+                type    = "choice", 
+                choices = ['lines', 'json',],
+                dest    = "error_format",
+                default = 'lines',
+                help    = "what the .error file of rejected rows holds, lines (the raw lines) or json (one object per row, with the row number, field type, value and reason)")
+
+    parser.add_option("-r", "--print-errors", 
+                type    = "int", 
+                dest    = "print_errors",
+                default = 10,
+                help    = "print the first this many rejected rows of every file, the rest only go to the .error file")
+
+    parser.add_option("-a", "--max-error-ratio", 
+                type    = "float", 
+                dest    = "max_error_ratio",
+                default = 0.0,
+                help    = "abort a file once more than this share of its rows is rejected, 0 never aborts; the rows rejected so far go to <file>.error, as nothing of the session is committed")
+
+    parser.add_option("-A", "--mapping-ttl", 
+                type    = "int", 
+                dest    = "mapping_ttl",
+                default = 60,
+                help    = "seconds the upload_session_field mapping of a data_type is used before it is read again")
+
+    parser.add_option("-s", "--skip", 
+                action  = "append", 
+                type    = "string", 
+                dest    = "skip",
+                default = [],
+                help    = "drop lines whose key has this value before their fields are cleaned, key=value, may be repeated")
+
+    parser.add_option("-j", "--metrics-json", 
+                type    = "string", 
+                dest    = "metrics_json",
+                default = None,
+                help    = "append a JSON summary of every loaded file to this file, - for stdout")
+
+    parser.add_option("-O", "--metrics-prom", 
+                type    = "string", 
+                dest    = "metrics_prom",
+                default = None,
+                help    = "keep Prometheus text format totals in this file")
+
     parser.add_option("-v", "--verbose", 
                 action  = "store_true", 
                 dest    = "verbose", 
@@ -82,25 +432,59 @@ def parse_args():
 
     (prog_options, prog_args) = parser.parse_args()
 
+    if prog_options.batch_size and not prog_options.target_table:
+        parser.error('--batch-size needs --target-table')
+
+    if prog_options.daemon and prog_options.batch_size:
+        parser.error('--batch-size can not be used with --daemon')
+
+    if prog_options.daemon and prog_options.stream:
+        parser.error('--stream can not be used with --daemon')
+
+    if prog_options.column_rows < 0:
+        parser.error('--column-rows can not be negative')
+
+    if not 0 <= prog_options.max_error_ratio < 1:
+        parser.error('--max-error-ratio must be at least 0 and below 1')
+
+    for skip in prog_options.skip:
+        if '=' not in skip:
+            parser.error('--skip takes key=value, not %s' % (skip,))
+
     return (prog_options, prog_args)
 
 class UploadSession(object):
-    def __init__(self, filename, data_type, *args, **kwargs):
+    inode = None
+    checkpoint_offset = None
+    start = 0
+    end = None
+    aborted = None
+    fingerprint = None
+
+    def __init__(self, filename, data_type, conn = None, *args, **kwargs):
         global pgsql_conn
-        self.pgsql_conn = pgsql_conn
+        self.pgsql_conn = conn or pgsql_conn
 
         self.pgsql_conn_cursor = self.pgsql_conn.cursor()
         self.pgsql_conn_cursor.execute("set lock_timeout = '3s'")
 
+        self.metrics = StageMetrics()
+
         self.filename = filename 
         self.data_type = data_type
 
         super(UploadSession, self).__init__(*args, **kwargs)
 
     def __enter__(self):
+        # the session handed out shares this one's cursor, which __exit__ closes
         for subclass in self.__class__.__subclasses__():
             if self.data_type in subclass.data_types:
-                return subclass(self.filename, self.data_type) 
+                log_session = subclass.detached(self.filename, self.data_type, *subclass.load_state(self.pgsql_conn_cursor, self.data_type))
+
+                log_session.pgsql_conn = self.pgsql_conn
+                log_session.pgsql_conn_cursor = self.pgsql_conn_cursor
+
+                return log_session
 
         raise TypeError()
 
@@ -134,52 +518,467 @@ class UploadSession(object):
     def parse_line(self, line):
         raise NotImplementedError()
 
-    def parse(self):
-        self.session_id = self.open()
+    def parse_fields(self, line):
+        raise NotImplementedError()
 
-        log_file = open(self.filename, 'r')
-        tmp_file = tempfile.TemporaryFile()
-        error_file = tempfile.NamedTemporaryFile(dir=os.path.dirname(self.filename))
+    @classmethod
+    def detached(cls, filename, data_type, *state):
+        self = cls.__new__(cls)
+
+        self.pgsql_conn = None
+        self.pgsql_conn_cursor = None
+
+        self.filename = filename
+        self.data_type = data_type
+
+        self.metrics = StageMetrics()
+
+        self.set_state(*state)
+
+        return self
+
+    def attach(self, filename):
+        log_session = self.detached(filename, self.data_type, *self.get_state())
+
+        log_session.pgsql_conn = self.pgsql_conn
+        log_session.pgsql_conn_cursor = self.pgsql_conn_cursor
+
+        return log_session
+
+    def set_range(self, inode, checkpoint_offset, start, end):
+        self.inode = inode
+        self.checkpoint_offset = checkpoint_offset
+        self.start = start
+        self.end = end
+
+    @classmethod
+    def load_state(cls, cursor, data_type):
+        return ()
+
+    def get_state(self):
+        return ()
+
+    def set_state(self):
+        pass
+
+    def exception_field(self):
+        field = None
+
+        # shared cleaners raise from plain functions, so the field is the
+        # innermost frame that has one
+        tb = sys.exc_traceback
+        while tb:
+            if isinstance(tb.tb_frame.f_locals.get('self'), LogField):
+                field = tb.tb_frame.f_locals['self']
+
+            tb = tb.tb_next
+
+        return field
+
+    def describe_exception(self):
+        field = self.exception_field()
+
+        exc_type, exc_value, tb_last = sys.exc_info()
+
+        while tb_last.tb_next:
+            tb_last = tb_last.tb_next
+
+        # the exception and where it was raised, a full traceback per bad row
+        # costs more than parsing a good one
+        reason = '%s at %s:%s' % (traceback.format_exception_only(exc_type, exc_value)[-1].strip(), os.path.basename(tb_last.tb_frame.f_code.co_filename), tb_last.tb_lineno,)
+
+        if field is not None:
+            return (field.__class__.__name__, field.value, reason,)
+
+        return (None, None, reason,)
+
+    def record_exception(self):
+        info = self.describe_exception()
+        self.metrics.error(info[0] or 'line')
+
+        return info
+
+    def describe_column_error(self, field_class, value):
+        # failures are rare, so the value is cleaned once more on its own to
+        # describe it exactly as the row by row path does
+        try:
+            field_class(value).clean()
+        except Exception:
+            return self.record_exception()
+
+        self.metrics.error(field_class.__name__)
+
+        return (field_class.__name__, value, 'rejected by the column cleaner',)
 
+    def reject(self, row_number, info, line):
+        field_type, value, reason = info
+
+        self.rows_rejected += 1
+
+        if self.rows_rejected <= print_errors:
+            print('\nException parsing row %s' %(row_number,))
+            print('%s: %s (%s)' % (field_type, value, reason,) if field_type else reason)
+            print(line)
+
+        if error_format == 'json':
+            print(json.dumps({'row': row_number, 'field_type': field_type, 'value': error_text(value), 'reason': reason, 'line': error_text(line)}, sort_keys = True), file = self.error_file)
+        else:
+            print(line, file = self.error_file)
+
+        if max_error_ratio and row_number >= error_ratio_min_rows and self.rows_rejected > max_error_ratio * row_number:
+            # the sidecar is kept, it is all there is to tell what was wrong
+            self.close_error_file(aborted = True)
+
+            raise ErrorRatioExceeded('%s of the first %s rows rejected' % (self.rows_rejected, row_number,))
+
+    def progress(self):
+        sys.stdout.write('#')
+        sys.stdout.flush()
+
+    def prepare(self, lines, reject = None, progress = None):
+        reject = reject or self.reject
+        progress = progress or self.progress
+
+        lines = self.hash_lines(lines)
+
+        if column_rows:
+            return self.prepare_columns(lines, reject, progress)
+
+        return self.prepare_rows(lines, reject, progress)
+
+    def hash_lines(self, lines):
+        # the adler32 of the bytes read, so a loaded file can be told from
+        # one that only shares its size and head
+        content_hash = 1
+        content_length = 0
+
+        for line in lines:
+            content_hash = zlib.adler32(line, content_hash)
+            content_length += len(line)
+
+            yield line
+
+        self.content_hash = content_hash & 0xffffffff
+        self.content_length = content_length
+
+    def track_ts(self, facts):
+        if facts.get('ts') is not None:
+            ts = int(facts['ts'])
+
+            if self.ts_min is None or ts < self.ts_min:
+                self.ts_min = ts
+
+            if self.ts_max is None or ts > self.ts_max:
+                self.ts_max = ts
+
+    def prepare_rows(self, lines, reject, progress):
         self.rows_processed = 0
         self.rows_prepared = 0
-        
-        for line in log_file:
+
+        self.ts_min = None
+        self.ts_max = None
+
+        cache_stats_start = cache_stats()
+
+        parse_line = self.parse_line
+        clean = clean_facts
+        encode = row_encoder.encode
+
+        if profile:
+            lines = self.metrics.timed_iter('read', lines)
+            parse_line = self.metrics.timed('tokenize', parse_line)
+            clean = self.metrics.timed('clean', self.metrics.clean_facts)
+            encode = self.metrics.timed('serialize', encode)
+
+        for line in lines:
             try:
                 self.rows_processed += 1
 
                 line = line.strip()
-                
-                facts = self.parse_line(line)
-                facts = {k:v.clean() for k,v in facts.iteritems()}
 
-                tmp_file.write('\t'.join((str(self.session_id), json.dumps(facts).encode('string-escape'),)) + '\n')
-                
+                facts = parse_line(line)
+
+                if facts is None:
+                    self.metrics.counters['rows_skipped'] += 1
+                    continue
+
+                facts = clean(facts)
+
+                row = encode(facts)
+
+                if target_table:
+                    self.track_ts(facts)
+
                 self.rows_prepared += 1
 
                 if not (self.rows_processed % 1000):
-                    sys.stdout.write('#')
-                    sys.stdout.flush()
+                    progress()
 
             except Exception as e:
-                print('\nException parsing row %s' %(self.rows_processed,))
-                tb_last = sys.exc_traceback
+                reject(self.rows_processed, self.record_exception(), line)
+                continue
+
+            yield row
+
+        self.cache_stats = cache_stats_since(cache_stats_start)
+
+    def prepare_columns(self, lines, reject, progress):
+        self.rows_processed = 0
+        self.rows_prepared = 0
+
+        self.ts_min = None
+        self.ts_max = None
+
+        cache_stats_start = cache_stats()
+
+        parse_fields = self.parse_fields
+        encode = row_encoder.encode
+
+        if profile:
+            lines = self.metrics.timed_iter('read', lines)
+            parse_fields = self.metrics.timed('tokenize', parse_fields)
+            encode = self.metrics.timed('serialize', encode)
+
+        column_plan = [(field_from, field_to, field_class, field_class.compile_column_cleaner(),) for field_from, field_to, field_class, _ in self.field_plan]
+
+        if profile:
+            column_plan = [(field_from, field_to, field_class, self.metrics.timed_column(field_class.__name__, column_cleaner),) for field_from, field_to, field_class, column_cleaner in column_plan]
+
+        lines = iter(lines)
+
+        while True:
+            chunk = list(itertools.islice(lines, column_rows))
+            if not chunk:
+                break
+
+            rows = []
+            errors = []
+
+            for line in chunk:
+                self.rows_processed += 1
+
+                line = line.strip()
+
+                try:
+                    fields = parse_fields(line)
+                except Exception:
+                    errors.append((self.rows_processed, self.record_exception(), line,))
+                else:
+                    if fields is None:
+                        self.metrics.counters['rows_skipped'] += 1
+                        continue
+
+                    # facts point at the plan entry that won their key until
+                    # the columns are cleaned, so keys land in parse_line order
+                    facts = {}
+                    for plan_index, (field_from, field_to, _, _) in enumerate(column_plan):
+                        if field_from in fields:
+                            facts[field_to] = plan_index
+
+                    rows.append((self.rows_processed, line, fields, facts,))
+
+                if not (self.rows_processed % 1000):
+                    progress()
+
+            columns = [([], [],) for _ in column_plan]
+
+            for row_index, (_, _, fields, facts) in enumerate(rows):
+                for plan_index in facts.itervalues():
+                    columns[plan_index][0].append(row_index)
+                    columns[plan_index][1].append(fields[column_plan[plan_index][0]])
+
+            failed = {}
 
-                while tb_last.tb_next:
-                    tb_last = tb_last.tb_next
+            for (_, field_to, field_class, column_cleaner), (row_indexes, values) in zip(column_plan, columns):
+                if not values:
+                    continue
 
-                field_info = None
-                if 'self' in tb_last.tb_frame.f_locals:
-                    if isinstance(tb_last.tb_frame.f_locals['self'], LogField):
-                        field_info = '%s: %s' % (tb_last.tb_frame.f_locals['self'].__class__, tb_last.tb_frame.f_locals['self'].value,)
+                column, column_failed = column_cleaner(values)
 
-                print(field_info or traceback.format_exc())
+                for row_index, value in itertools.izip(row_indexes, column):
+                    rows[row_index][3][field_to] = value
 
-                _ = map(lambda f: print(line, file=f), (sys.stdout, error_file,))
+                for i in column_failed:
+                    failed.setdefault(row_indexes[i], {})[field_to] = (field_class, values[i],)
+
+            for row_index, (row_number, line, _, facts) in enumerate(rows):
+                if row_index in failed:
+                    # the row by row path gives up on the first field it cleans
+                    field_to = next(k for k in facts if k in failed[row_index])
+
+                    errors.append((row_number, self.describe_column_error(*failed[row_index][field_to]), line,))
+                    continue
+
+                # rebuilt the way clean_facts builds it, so the JSON keeps its key order
+                facts = {k:v for k,v in facts.iteritems()}
+
+                try:
+                    row = encode(facts)
+
+                    if target_table:
+                        self.track_ts(facts)
+                except Exception:
+                    errors.append((row_number, self.record_exception(), line,))
+                    continue
+
+                self.rows_prepared += 1
+
+                yield row
+
+            for row_number, info, line in sorted(errors):
+                reject(row_number, info, line)
+
+        self.cache_stats = cache_stats_since(cache_stats_start)
+
+    def copy_row(self, row):
+        return row_encoder.copy_row(self.session_id, row)
+
+    def copy_rows(self, rows):
+        yield row_encoder.copy_header
+
+        # raised from inside COPY's read() an abort would come back as a failed
+        # COPY, so the rows just end and check_aborted raises it before commit
+        try:
+            for row in rows:
+                yield self.copy_row(row)
+        except ErrorRatioExceeded as e:
+            self.aborted = e
+
+        yield row_encoder.copy_trailer
+
+    def check_aborted(self):
+        if self.aborted is not None:
+            raise self.aborted
+
+    def open_error_file(self):
+        self.error_file = tempfile.NamedTemporaryFile(dir=os.path.dirname(self.filename))
+
+        self.rows_rejected = 0
+
+    def close_error_file(self, aborted = False):
+        if self.rows_rejected > print_errors:
+            print('\n%s of %s rejected rows of %s only went to the error file' % (self.rows_rejected - print_errors, self.rows_rejected, self.filename,))
+
+        if self.error_file.tell():
+            # an aborted session is rolled back, so its id would name nothing,
+            # and the next abort of the same file replaces the sidecar
+            if aborted:
+                error_filename = '%s.error' % (self.filename,)
+
+                if os.path.exists(error_filename):
+                    os.unlink(error_filename)
+            else:
+                error_filename = '%s.%s.error' % (self.filename, self.session_id,)
+
+            os.link(self.error_file.name, error_filename)
+
+        self.error_file.close()
+
+    def parse(self, parse_pool = None, chunk_size = None, stream = False):
+        if parse_pool:
+            return self.parse_remote(parse_pool.file_results(parse_pool.submit_file(self.__class__, self.data_type, self.get_state(), self.filename, chunk_size, self.start, self.end)))
+
+        if stream:
+            return self.parse_stream()
+
+        self.session_id = self.open()
+
+        log_file = open_log_file(self.filename)
+        tmp_file = tempfile.TemporaryFile()
+        self.open_error_file()
+
+        for chunk in self.copy_rows(self.prepare(read_range(log_file, self.start, self.end))):
+            tmp_file.write(chunk)
+
+        self.check_aborted()
 
         tmp_file.seek(0)
 
-        self.pgsql_conn_cursor.execute  ( \
+        self.load(tmp_file)
+
+        log_file.close()
+        tmp_file.close()
+
+        self.close_error_file()
+
+    def prepare_file(self):
+        with open_log_file(self.filename) as log_file:
+            for row in self.prepare(read_range(log_file, self.start, self.end)):
+                yield row
+
+    def parse_stream(self):
+        self.session_id = self.open()
+
+        log_file = open_log_file(self.filename)
+        self.open_error_file()
+
+        self.load(RowStream(background(self.copy_rows(self.prepare(read_range(log_file, self.start, self.end))))))
+
+        log_file.close()
+
+        self.close_error_file()
+
+    def parse_remote(self, messages):
+        self.session_id = self.open()
+        self.open_error_file()
+
+        self.load(RowStream(self.copy_rows(self.receive(messages))))
+
+        self.close_error_file()
+
+    def receive(self, messages):
+        self.rows_processed = 0
+        self.rows_prepared = 0
+        self.ts_min = None
+        self.ts_max = None
+        self.cache_stats = {}
+        self.content_hash = 1
+        self.content_length = 0
+
+        rows_before = 0
+
+        for message in messages:
+            if message[0] == 'rows':
+                _, rows, errors, rows_processed = message
+
+                for row_number, info, line in errors:
+                    self.reject(rows_before + row_number, info, line)
+
+                for row in rows:
+                    yield row
+
+                for _ in xrange(self.rows_processed // 1000, (rows_before + rows_processed) // 1000):
+                    self.progress()
+
+                self.rows_processed = rows_before + rows_processed
+            elif message[0] == 'done':
+                _, rows_processed, rows_prepared, cache_stats, ts_min, ts_max, metrics, content_hash, content_length = message
+
+                self.metrics.merge(metrics)
+
+                # chunks come in file order, so their hashes chain up to the file's
+                self.content_hash = adler32_combine(self.content_hash, content_hash, content_length)
+                self.content_length += content_length
+
+                rows_before += rows_processed
+
+                self.rows_processed = rows_before
+                self.rows_prepared += rows_prepared
+
+                if ts_min is not None:
+                    self.ts_min = min(ts_min, self.ts_min) if self.ts_min is not None else ts_min
+                    self.ts_max = max(ts_max, self.ts_max) if self.ts_max is not None else ts_max
+
+                for name, (hits, misses) in cache_stats.iteritems():
+                    self.cache_stats[name] = tuple(map(sum, zip(self.cache_stats.get(name, (0, 0,)), (hits, misses,))))
+            else:
+                raise RuntimeError('worker failed parsing %s:\n%s' % (self.filename, message[1],))
+
+    def load(self, copy_file):
+        if target_table:
+            return self.load_target(copy_file)
+
+        self.metrics.timed('ddl', self.pgsql_conn_cursor.execute)( \
                                             ' \
                                                 drop table if exists \
                                                     %(data_type)s_upload_data_%(session_id)s \
@@ -190,7 +989,7 @@ class UploadSession(object):
                                             } \
                                         )
 
-        self.pgsql_conn_cursor.execute  ( \
+        self.metrics.timed('ddl', self.pgsql_conn_cursor.execute)( \
                                             ' \
                                                 create table \
                                                     %(data_type)s_upload_data_%(session_id)s    ( \
@@ -204,18 +1003,38 @@ class UploadSession(object):
                                             } \
                                         )
 
-        self.pgsql_conn_cursor.copy_from( \
-                                            tmp_file, \
-                                            ' \
-                                                %(data_type)s_upload_data_%(session_id)s \
-                                            ' % \
-                                            { \
-                                                'data_type':    self.data_type, \
-                                                'session_id':   self.session_id, \
-                                            } \
-                                        )
-
-        self.pgsql_conn_cursor.execute  ( \
+        if row_encoder.copy_options is None:
+            self.metrics.timed('copy', self.pgsql_conn_cursor.copy_from)( \
+                                                copy_file, \
+                                                ' \
+                                                    %(data_type)s_upload_data_%(session_id)s \
+                                                ' % \
+                                                { \
+                                                    'data_type':    self.data_type, \
+                                                    'session_id':   self.session_id, \
+                                                } \
+                                            )
+        else:
+            self.metrics.timed('copy', self.pgsql_conn_cursor.copy_expert)( \
+                                                ' \
+                                                    copy \
+                                                        %(data_type)s_upload_data_%(session_id)s \
+                                                    from \
+                                                        stdin \
+                                                    with \
+                                                        %(copy_options)s \
+                                                ' % \
+                                                { \
+                                                    'data_type':    self.data_type, \
+                                                    'session_id':   self.session_id, \
+                                                    'copy_options': row_encoder.copy_options, \
+                                                }, \
+                                                copy_file \
+                                            )
+
+        self.check_aborted()
+
+        self.metrics.timed('update', self.pgsql_conn_cursor.execute)( \
                                             ' \
                                                 update \
                                                     upload_session \
@@ -245,101 +1064,758 @@ class UploadSession(object):
                                             } \
                                         )
 
-        self.pgsql_conn.commit() 
+        self.save_fingerprint()
+        self.save_checkpoint()
 
-        log_file.close()
-        tmp_file.close()
+        self.metrics.timed('commit', self.pgsql_conn.commit)() 
 
-        if error_file.tell():
-           os.link(error_file.name, '%s.%s.error' % (self.filename, self.session_id,)) 
+    def load_target(self, copy_file):
+        self.copy_target(copy_file)
+        self.update_target()
+        self.save_fingerprint()
+        self.save_checkpoint()
 
-        error_file.close()
+        self.metrics.timed('commit', self.pgsql_conn.commit)() 
 
-class UploadSessionPlayerEvents(UploadSession):
-    data_types = ['player_events', 'player_events_test',]
+    def copy_target(self, copy_file):
+        self.metrics.timed('copy', self.pgsql_conn_cursor.copy_expert)( \
+                                            ' \
+                                                copy \
+                                                    %(target_table)s \
+                                                from \
+                                                    stdin \
+                                                with \
+                                                    %(copy_options)s \
+                                            ' % \
+                                            { \
+                                                'target_table': target_table, \
+                                                'copy_options': row_encoder.copy_options, \
+                                            }, \
+                                            copy_file \
+                                        )
 
-    anonymous_fields = ('rts', 'ip',)
+        self.check_aborted()
 
-    def __init__(self, filename, data_type, *args, **kwargs):
-        super(UploadSessionPlayerEvents, self).__init__(filename, data_type, *args, **kwargs)
+    def update_target(self):
+        # ts range comes from prepare, dt is still derived by the server so it
+        # matches what the staging table scan gives for the session time zone
+        self.metrics.timed('update', self.pgsql_conn_cursor.execute)( \
+                                            ' \
+                                                update \
+                                                    upload_session \
+                                                set \
+                                                    rows_processed = %(rows_processed)s, \
+                                                    rows_prepared = %(rows_prepared)s, \
+                                                    ts_min = %(ts_min)s, \
+                                                    ts_max = %(ts_max)s, \
+                                                    dt = (timestamp \'epoch\' at time zone \'GMT\' + interval \'1 second\' * %(ts_min)s::int)::date \
+                                                where \
+                                                    id = %(session_id)s \
+                                            ', \
+                                            { \
+                                                'rows_processed':   self.rows_processed, \
+                                                'rows_prepared':    self.rows_prepared, \
+                                                'ts_min':           self.ts_min, \
+                                                'ts_max':           self.ts_max, \
+                                                'session_id':       self.session_id, \
+                                            } \
+                                        )
+
+    def save_fingerprint(self):
+        # only set while duplicates are looked for, so a database without
+        # these columns still loads with --force-reload or --follow
+        if self.fingerprint is None:
+            return
+
+        file_size, head_hash = self.fingerprint
 
         self.pgsql_conn_cursor.execute  ( \
                                             ' \
-                                                select \
-                                                    field_from, \
-                                                    field_to, \
-                                                    field_type, \
-                                                    is_mandatory \
-                                                from \
-                                                    upload.upload_session_field \
+                                                update \
+                                                    upload_session \
+                                                set \
+                                                    file_size = %(file_size)s, \
+                                                    head_hash = %(head_hash)s, \
+                                                    content_hash = %(content_hash)s \
                                                 where \
-                                                    data_type = \'%(data_type)s\' \
-                                            ' % \
+                                                    id = %(session_id)s \
+                                            ', \
                                             { \
-                                                'data_type':    self.data_type, \
+                                                'file_size':    file_size, \
+                                                'head_hash':    head_hash, \
+                                                'content_hash': self.content_hash, \
+                                                'session_id':   self.session_id, \
                                             } \
                                         )
 
-        self.fields = self.pgsql_conn_cursor.fetchall()
+    def save_checkpoint(self):
+        if self.inode is None:
+            return
+
+        if self.checkpoint_offset is None:
+            self.pgsql_conn_cursor.execute  ( \
+                                                ' \
+                                                    insert into \
+                                                        upload_checkpoint   ( \
+                                                                                log_filename, \
+                                                                                inode, \
+                                                                                data_type, \
+                                                                                file_offset, \
+                                                                                session_id \
+                                                                            ) \
+                                                    values  ( \
+                                                                %(log_filename)s, \
+                                                                %(inode)s, \
+                                                                %(data_type)s, \
+                                                                %(file_offset)s, \
+                                                                %(session_id)s \
+                                                            ) \
+                                                ', \
+                                                { \
+                                                    'log_filename': os.path.basename(self.filename), \
+                                                    'inode':        self.inode, \
+                                                    'data_type':    self.data_type, \
+                                                    'file_offset':  self.end, \
+                                                    'session_id':   self.session_id, \
+                                                } \
+                                            )
+
+            return
+
+        # only moves the offset on if nobody else has since we read it
+        self.pgsql_conn_cursor.execute  ( \
+                                            ' \
+                                                update \
+                                                    upload_checkpoint \
+                                                set \
+                                                    file_offset = %(file_offset)s, \
+                                                    session_id = %(session_id)s \
+                                                where \
+                                                    log_filename = %(log_filename)s and \
+                                                    inode = %(inode)s and \
+                                                    data_type = %(data_type)s and \
+                                                    file_offset = %(checkpoint_offset)s \
+                                            ', \
+                                            { \
+                                                'log_filename':         os.path.basename(self.filename), \
+                                                'inode':                self.inode, \
+                                                'data_type':            self.data_type, \
+                                                'file_offset':          self.end, \
+                                                'session_id':           self.session_id, \
+                                                'checkpoint_offset':    self.checkpoint_offset, \
+                                            } \
+                                        )
 
-        self.mandatory_fields = set(x[0] for x in filter(lambda x: x[3], self.fields))
+        if self.pgsql_conn_cursor.rowcount != 1:
+            raise RuntimeError('checkpoint of %s moved while it was being loaded' % (self.filename,))
 
+class UploadSessionPlayerEvents(UploadSession):
+    data_types = ['player_events', 'player_events_test',]
 
-    def parse_line(self, line):
-        def line_to_fields(line):
-            return \
-                {i.groupdict()['id'].lower():i.groupdict()['value'] for i in re.finditer('(?i)(?<=[|])(?P<id>[a-z0-9_-]{,32}):(?P<value>[^|]*)', '|' + line)}
+    anonymous_fields = ('rts', 'ip',)
+
+    def __init__(self, filename, data_type, *args, **kwargs):
+        super(UploadSessionPlayerEvents, self).__init__(filename, data_type, *args, **kwargs)
+
+        self.set_state(*self.load_state(self.pgsql_conn_cursor, self.data_type))
+
+    @classmethod
+    def load_state(cls, cursor, data_type):
+        # one query per data_type every mapping_ttl seconds rather than per
+        # file, so a long run still picks up mapping changes
+        cached = field_mappings.get(data_type)
+
+        if cached is not None and time.time() - cached[0] < mapping_ttl:
+            return (cached[1],)
+
+        cursor.execute  ( \
+                            ' \
+                                select \
+                                    field_from, \
+                                    field_to, \
+                                    field_type, \
+                                    is_mandatory \
+                                from \
+                                    upload.upload_session_field \
+                                where \
+                                    data_type = \'%(data_type)s\' \
+                            ' % \
+                            { \
+                                'data_type':    data_type, \
+                            } \
+                        )
+
+        fields = cursor.fetchall()
+        field_mappings[data_type] = (time.time(), fields,)
+
+        return (fields,)
+
+    def set_fields(self, fields):
+        self.fields = fields
+
+        # workers get the fields with every task, compiling them once will do
+        key = tuple(fields)
+        if key not in field_plans:
+            field_plans[key] = compile_field_plan(fields)
 
-        raw_fields = \
-            collections.defaultdict \
-            ( \
-                lambda: None, \
-                line_to_fields(line) \
-            )
+        self.field_plan = field_plans[key]
 
-        raw_fields.update(zip(self.anonymous_fields, re.split('[|]', line)))
+        self.mandatory_fields = set(field_from for field_from, _, _, is_mandatory in self.field_plan if is_mandatory)
 
-        fields = {}
-        for k,v in raw_fields.iteritems():
-            try_line = line_to_fields('%s:%s' % (k, URLDecodedField(v).clean(),))
-            fields.update(try_line) 
+        # keys nothing maps or skips on are never decoded
+        self.wanted_fields = frozenset(field_from for field_from, _, _, _ in self.field_plan) | frozenset(skip_values)
 
-        assert self.mandatory_fields == self.mandatory_fields & set(fields.keys())
+    def get_state(self):
+        return (self.fields,)
+
+    def set_state(self, fields):
+        self.set_fields(fields)
+
+    def parse_fields(self, line):
+        fields = tokenize_fields(line, self.anonymous_fields, self.wanted_fields)
+
+        for field_from, values in skip_values.iteritems():
+            if fields.get(field_from) in values:
+                return None
+
+        assert self.mandatory_fields == self.mandatory_fields & set(fields.keys()), 'missing mandatory fields %s' % (', '.join(sorted(self.mandatory_fields - set(fields.keys()))),)
+
+        return fields
+
+    def parse_line(self, line):
+        fields = self.parse_fields(line)
+
+        if fields is None:
+            return None
 
         facts = {}
 
-        def process_field(field_from, field_to, field_type, _):
+        for field_from, field_to, field_class, _ in self.field_plan:
             if field_from in fields:
-                facts[field_to] = eval('%s(fields[\'%s\'])' % (field_type, field_from,))
-
-        for field in self.fields:
-            process_field(*field)
+                facts[field_to] = field_class(fields[field_from])
 
         return facts
 
+def format_cache_stats(stats):
+    return ''.join(', %s cache %.1f%% hits' % (name, 100.0 * hits / (hits + misses),) for name, (hits, misses) in sorted(stats.iteritems()) if hits + misses)
+
+def follow_range(conn, filename, data_type, max_bytes = 0):
+    inode = os.stat(filename).st_ino
+
+    cursor = conn.cursor()
+
+    cursor.execute  ( \
+                        ' \
+                            select \
+                                file_offset \
+                            from \
+                                upload_checkpoint \
+                            where \
+                                log_filename = %s and \
+                                inode = %s and \
+                                data_type = %s \
+                        ', \
+                        ( \
+                            os.path.basename(filename), \
+                            inode, \
+                            data_type, \
+                        ) \
+                    )
+
+    checkpoint = cursor.fetchone()
+    cursor.close()
+
+    checkpoint_offset = checkpoint[0] if checkpoint else None
+
+    size = os.path.getsize(filename)
+
+    # a file shorter than its checkpoint was truncated in place, start over
+    start = checkpoint_offset or 0
+    if start > size:
+        start = 0
+
+    end = complete_lines_end(filename, start, min(size, start + max_bytes) if max_bytes else size)
+
+    return (inode, checkpoint_offset, start, end,)
+
+def file_head_hash(filename, head_size = 65536):
+    with open(filename, 'rb') as log_file:
+        return hashlib.md5(log_file.read(head_size)).hexdigest()
+
+def file_content_hash(filename, block_size = 1024 * 1024):
+    content_hash = 1
+
+    # the bytes the parser reads, decompressed ones for compressed files
+    with open_log_file(filename) as log_file:
+        for block in iter(lambda: log_file.read(block_size), ''):
+            content_hash = zlib.adler32(block, content_hash)
+
+    return content_hash & 0xffffffff
+
+def file_fingerprint(filename):
+    return (os.path.getsize(filename), file_head_hash(filename),)
+
+def loaded_session(conn, filename, data_type, fingerprint):
+    cursor = conn.cursor()
+
+    cursor.execute  ( \
+                        ' \
+                            select \
+                                id, \
+                                content_hash \
+                            from \
+                                upload_session \
+                            where \
+                                data_type = %s and \
+                                file_size = %s and \
+                                head_hash = %s and \
+                                content_hash is not null \
+                            order by \
+                                id \
+                        ', \
+                        (data_type,) + fingerprint \
+                    )
+
+    candidates = cursor.fetchall()
+    cursor.close()
+
+    # size and head only find candidates, the whole file is read to confirm
+    # one before anything is skipped
+    if not candidates:
+        return None
+
+    content_hash = file_content_hash(filename)
+
+    for session_id, candidate_hash in candidates:
+        if candidate_hash == content_hash:
+            return session_id
+
+    return None
+
+def submit_files(parse_pool, log_filenames, data_type, chunk_size = None, file_ranges = None):
+    if not log_filenames:
+        return []
+
+    with UploadSession(log_filenames[0], data_type) as log_session:
+        session_class = log_session.__class__
+        session_state = log_session.get_state()
+
+    file_ranges = file_ranges or [(None, None, 0, None,)] * len(log_filenames)
+
+    return [parse_pool.submit_file(session_class, data_type, session_state, log_filename, chunk_size, start, end) for log_filename, (_, _, start, end) in zip(log_filenames, file_ranges)]
+
+def batch_files(log_filenames, batch_size, file_sizes = None):
+    batches = []
+    batch_bytes = 0
+
+    file_sizes = file_sizes or [os.path.getsize(log_filename) for log_filename in log_filenames]
+
+    for log_filename, file_size in zip(log_filenames, file_sizes):
+        if not batches or batch_bytes + file_size > batch_size:
+            batches.append([])
+            batch_bytes = 0
+
+        batches[-1].append(log_filename)
+        batch_bytes += file_size
+
+    return batches
+
+def parse_batch(log_filenames, data_type, file_messages = None, stream = False, file_ranges = None, fingerprints = None):
+    with UploadSession(log_filenames[0], data_type) as first_session:
+        log_sessions = [first_session] + [first_session.attach(log_filename) for log_filename in log_filenames[1:]]
+
+        if file_ranges:
+            for log_session, file_range in zip(log_sessions, file_ranges):
+                log_session.set_range(*file_range)
+
+        if fingerprints:
+            for log_session in log_sessions:
+                log_session.fingerprint = fingerprints.get(log_session.filename)
+
+        for log_session in log_sessions:
+            log_session.open_error_file()
+
+        def copy_rows():
+            yield row_encoder.copy_header
+
+            # an abort ends the batch's rows, it is raised once COPY is back
+            for index, log_session in enumerate(log_sessions):
+                if file_messages:
+                    rows = log_session.receive(file_messages[index])
+                else:
+                    rows = log_session.prepare_file()
+
+                try:
+                    for row in rows:
+                        yield log_session.copy_row(row)
+                except ErrorRatioExceeded as e:
+                    log_session.aborted = e
+                    break
+
+            yield row_encoder.copy_trailer
+
+        try:
+            for log_session in log_sessions:
+                log_session.session_id = log_session.open()
+
+            first_session.copy_target(RowStream(background(copy_rows()) if stream else copy_rows()))
+
+            for log_session in log_sessions:
+                log_session.check_aborted()
+
+            for log_session in log_sessions:
+                log_session.update_target()
+                log_session.save_fingerprint()
+                log_session.save_checkpoint()
+
+            first_session.metrics.timed('commit', first_session.pgsql_conn.commit)()
+        except Exception:
+            for log_session in log_sessions:
+                log_session.error_file.close()
+
+            raise
+
+        for log_session in log_sessions:
+            log_session.close_error_file()
+
+    return log_sessions
+
+def list_log_files(directory, mask):
+    return sorted(set(itertools.chain.from_iterable(glob.glob(os.path.join(directory, file_mask)) for file_mask in mask.split(','))))
+
+def load_file(conn, log_filename, data_type, parse_pool, chunk_size = None, follow = False, follow_max = 0, force_reload = False):
+    fingerprint = None
+
+    if not follow and not force_reload:
+        fingerprint = file_fingerprint(log_filename)
+
+        session_id = loaded_session(conn, log_filename, data_type, fingerprint)
+        conn.rollback()
+
+        if session_id is not None:
+            print('Skipping file %s, its content was loaded by session %s' % (log_filename, session_id,))
+
+            return None
+
+    with UploadSession(log_filename, data_type, conn) as log_session:
+        log_session.fingerprint = fingerprint
+
+        if follow:
+            log_session.set_range(*follow_range(conn, log_filename, data_type, follow_max))
+
+            if log_session.start == log_session.end:
+                return None
+
+        time_start = time.time()
+        print('Started processing file %s' % (log_filename,))
+
+        file_tasks = parse_pool.submit_file(log_session.__class__, data_type, log_session.get_state(), log_filename, chunk_size, log_session.start, log_session.end)
+
+        try:
+            log_session.parse_remote(parse_pool.file_results(file_tasks))
+        finally:
+            parse_pool.drain(file_tasks)
+
+        print('\nFinished processing file %s in %s - %s of %s rows processed%s' %(log_filename, str(datetime.timedelta(seconds = int(time.time() - time_start))), log_session.rows_prepared, log_session.rows_processed, format_cache_stats(log_session.cache_stats),))
+
+        report_file(log_session, time.time() - time_start)
+
+    return log_session
+
+def serve(prog_options, parse_pool):
+    conn_pool = psycopg2.pool.ThreadedConnectionPool(1, prog_options.loaders, **{i.replace('db',''):j for i,j in vars(prog_options).iteritems() if re.match('db', i)})
+
+    if target_table:
+        conn = conn_pool.getconn()
+        row_encoder.set_columns(*target_columns(conn, target_table))
+        conn.rollback()
+        conn_pool.putconn(conn)
+
+    stopping = threading.Event()
+    file_queue = Queue.Queue(prog_options.queue_depth)
+
+    # files queued or being loaded, and the (size, mtime) files were last
+    # loaded or failed at, so they are only picked up again once they change
+    pending = set()
+    done = {}
+    lock = threading.Lock()
+
+    def loader():
+        while not stopping.is_set():
+            try:
+                log_filename, stat = file_queue.get(timeout = 1)
+            except Queue.Empty:
+                continue
+
+            # whatever is still queued is left on disk for the next start
+            if stopping.is_set():
+                break
+
+            conn = conn_pool.getconn()
+
+            try:
+                load_file(conn, log_filename, prog_options.data_type, parse_pool, prog_options.chunk_size * 1024 * 1024, prog_options.follow, prog_options.follow_max * 1024 * 1024, prog_options.force_reload)
+
+                if not prog_options.follow:
+                    os.unlink(log_filename)
+            except ErrorRatioExceeded as e:
+                print('\nAborted processing file %s: %s' % (log_filename, e,))
+            except Exception:
+                print('\nFailed processing file %s' % (log_filename,))
+                print(traceback.format_exc())
+            finally:
+                conn_pool.putconn(conn, close = bool(conn.closed))
+
+                with lock:
+                    pending.discard(log_filename)
+                    done[log_filename] = stat
+
+    def stop(signum, frame):
+        print('\nReceived signal %s, finishing files in flight' % (signum,))
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    loaders = [threading.Thread(target = loader) for _ in xrange(prog_options.loaders)]
+    for loader_thread in loaders:
+        loader_thread.start()
+
+    print('Watching %s for %s' % (prog_options.dir, prog_options.mask,))
+
+    last_stats = {}
+    while not stopping.is_set():
+        stats = {}
+        for log_filename in list_log_files(prog_options.dir, prog_options.mask):
+            try:
+                stat = os.stat(log_filename)
+            except OSError:
+                continue
+
+            stats[log_filename] = (stat.st_size, stat.st_mtime,)
+
+        for log_filename, stat in sorted(stats.iteritems()):
+            if stopping.is_set():
+                break
+
+            # whole files are only loaded once they stopped changing, followed
+            # files whenever they have grown
+            if not prog_options.follow and last_stats.get(log_filename) != stat:
+                continue
+
+            if prog_options.follow and is_compressed(log_filename):
+                continue
+
+            with lock:
+                if log_filename in pending or done.get(log_filename) == stat:
+                    continue
+
+                pending.add(log_filename)
+
+            # a full queue holds the scan back until the loaders catch up
+            while not stopping.is_set():
+                try:
+                    file_queue.put((log_filename, stat,), timeout = 1)
+                    break
+                except Queue.Full:
+                    pass
+
+        with lock:
+            for log_filename in set(done) - set(stats):
+                del done[log_filename]
+
+        last_stats = stats
+
+        stopping.wait(prog_options.poll_interval)
+
+    for loader_thread in loaders:
+        while loader_thread.is_alive():
+            loader_thread.join(1)
+
+    parse_pool.close()
+    conn_pool.closeall()
+
+def report_file(log_session, elapsed):
+    if metrics_report is None:
+        return
+
+    log_session.metrics.counters.update(files = 1, rows_processed = log_session.rows_processed, rows_prepared = log_session.rows_prepared)
+
+    summary =   { \
+                    'file':             log_session.filename, \
+                    'data_type':        log_session.data_type, \
+                    'session_id':       log_session.session_id, \
+                    'rows_processed':   log_session.rows_processed, \
+                    'rows_prepared':    log_session.rows_prepared, \
+                    'rows_skipped':     log_session.metrics.counters['rows_skipped'], \
+                    'seconds':          round(elapsed, 3), \
+                    'caches':           {name: {'hits': hits, 'misses': misses} for name, (hits, misses) in log_session.cache_stats.iteritems()}, \
+                }
+
+    summary.update(log_session.metrics.summary())
+
+    metrics_report.file_done(summary, log_session.metrics)
+
 def main():
     (prog_options, prog_args) = parse_args()
 
+    global row_encoder, target_table, profile, metrics_report, column_rows, error_format, print_errors, max_error_ratio, mapping_ttl, skip_values
+    target_table = prog_options.target_table
+    profile = prog_options.profile
+    column_rows = prog_options.column_rows
+    error_format = prog_options.error_format
+    print_errors = prog_options.print_errors
+    max_error_ratio = prog_options.max_error_ratio
+    mapping_ttl = prog_options.mapping_ttl
+
+    skip_values = {}
+    for skip in prog_options.skip:
+        field_from, value = skip.split('=', 1)
+        skip_values.setdefault(field_from.lower(), set()).add(value)
+
+    if prog_options.metrics_json or prog_options.metrics_prom:
+        metrics_report = MetricsReport(prog_options.metrics_json, prog_options.metrics_prom, {'data_type': prog_options.data_type})
+    row_encoder = make_row_encoder(prog_options.row_encoder, binary = bool(target_table))
+
+    GeoIP2CityDBField.cache.resize(prog_options.geoip_cache)
+    RefererField.cache.resize(prog_options.value_cache * 1024 * 1024)
+    UserAgentField.cache.resize(prog_options.value_cache * 1024 * 1024)
+    configure_geoip(prog_options.geoip_db, prog_options.geoip_mode)
+
+    parse_pool = None
+    if prog_options.workers or prog_options.daemon:
+        if os.path.exists(log2db_ng_field_types.geoip_city_path):
+            open_geoip()
+
+        parse_pool = ParseWorkerPool(max(prog_options.workers, 1), prog_options.worker_memory * 1024 * 1024, process_group = prog_options.daemon)
+
+    if prog_options.daemon:
+        return serve(prog_options, parse_pool)
+
     global pgsql_conn
     pgsql_conn = psycopg2.connect(**{i.replace('db',''):j for i,j in vars(prog_options).iteritems() if re.match('db', i)})
 
+    if target_table:
+        row_encoder.set_columns(*target_columns(pgsql_conn, target_table))
+
     if prog_args:
         log_filenames = prog_args
     else:
-        log_filenames = sorted(glob.glob(os.path.join(prog_options.dir, prog_options.mask)))[:prog_options.limit]
+        log_filenames = list_log_files(prog_options.dir, prog_options.mask)[:prog_options.limit]
+
+    file_ranges = None
+    if prog_options.follow:
+        for log_filename in filter(is_compressed, log_filenames):
+            print('Skipping compressed file %s, only plain files can be followed' % (log_filename,))
+
+        log_filenames = [log_filename for log_filename in log_filenames if not is_compressed(log_filename)]
+
+        followed = [(log_filename, follow_range(pgsql_conn, log_filename, prog_options.data_type, prog_options.follow_max * 1024 * 1024),) for log_filename in log_filenames]
+        pgsql_conn.rollback()
+
+        log_filenames = [log_filename for log_filename, (_, _, start, end) in followed if start < end]
+        file_ranges = [file_range for _, file_range in followed if file_range[2] < file_range[3]]
+
+    # files whose content is already in, left behind by a crash before the
+    # unlink or delivered again, are only removed
+    fingerprints = {}
+    if not prog_options.follow and not prog_options.force_reload:
+        fingerprints = {log_filename: file_fingerprint(log_filename) for log_filename in log_filenames}
+
+        loaded = [(log_filename, loaded_session(pgsql_conn, log_filename, prog_options.data_type, fingerprints[log_filename]),) for log_filename in log_filenames]
+        pgsql_conn.rollback()
+
+        for log_filename, session_id in loaded:
+            if session_id is not None:
+                print('Skipping file %s, its content was loaded by session %s' % (log_filename, session_id,))
+                os.unlink(log_filename)
+
+        log_filenames = [log_filename for log_filename, session_id in loaded if session_id is None]
 
     print('Processing %s files' % (len(log_filenames),))
+
+    if parse_pool:
+        file_tasks = submit_files(parse_pool, log_filenames, prog_options.data_type, prog_options.chunk_size * 1024 * 1024, file_ranges)
     
-    for log_filename in log_filenames:
-        with UploadSession(log_filename, prog_options.data_type) as log_session:
-            time_start = time.time()
-            print('Started processing file %s' % (log_filename,))
+    if prog_options.batch_size:
+        batches = batch_files(log_filenames, prog_options.batch_size * 1024 * 1024, [end - start for _, _, start, end in file_ranges] if file_ranges else None)
+    else:
+        batches = [[log_filename] for log_filename in log_filenames]
+
+    batch_start = 0
+    for batch in batches:
+        indexes = range(batch_start, batch_start + len(batch))
+        batch_start += len(batch)
+
+        batch_ranges = [file_ranges[index] for index in indexes] if file_ranges else None
+
+        if len(batch) > 1:
+            try:
+                time_start = time.time()
+                print('Started processing batch of %s files' % (len(batch),))
+
+                log_sessions = parse_batch(batch, prog_options.data_type, [parse_pool.file_results(file_tasks[index]) for index in indexes] if parse_pool else None, prog_options.stream, batch_ranges, fingerprints)
+            except Exception:
+                print('\nFailed processing batch of %s files, retrying them one by one' % (len(batch),))
+                print(traceback.format_exc())
+
+                # later files are already queued behind these on the workers,
+                # so the retries are parsed in process
+                if parse_pool:
+                    for index in indexes:
+                        parse_pool.drain(file_tasks[index])
+                        file_tasks[index] = None
+            else:
+                for log_session in log_sessions:
+                    print('\nFinished processing file %s in %s - %s of %s rows processed%s' %(log_session.filename, str(datetime.timedelta(seconds = int(time.time() - time_start))), log_session.rows_prepared, log_session.rows_processed, format_cache_stats(log_session.cache_stats),))
+
+                    report_file(log_session, time.time() - time_start)
+
+                    if not prog_options.follow:
+                        os.unlink(log_session.filename)
+
+                continue
+
+        for index, log_filename in zip(indexes, batch):
+            try:
+                with UploadSession(log_filename, prog_options.data_type) as log_session:
+                    log_session.fingerprint = fingerprints.get(log_filename)
+
+                    if file_ranges:
+                        log_session.set_range(*file_ranges[index])
+
+                    time_start = time.time()
+                    print('Started processing file %s' % (log_filename,))
+
+                    if parse_pool and file_tasks[index] is not None:
+                        log_session.parse_remote(parse_pool.file_results(file_tasks[index]))
+                    else:
+                        log_session.parse(stream = prog_options.stream)
+
+                    print('\nFinished processing file %s in %s - %s of %s rows processed%s' %(log_filename, str(datetime.timedelta(seconds = int(time.time() - time_start))), log_session.rows_prepared, log_session.rows_processed, format_cache_stats(log_session.cache_stats),))
+
+                    report_file(log_session, time.time() - time_start)
+            except ErrorRatioExceeded as e:
+                print('\nAborted processing file %s: %s' % (log_filename, e,))
+
+                continue
+            except Exception:
+                if not parse_pool:
+                    raise
+
+                print('\nFailed processing file %s' % (log_filename,))
+                print(traceback.format_exc())
 
-            log_session.parse()
+                continue
+            finally:
+                if parse_pool and file_tasks[index] is not None:
+                    parse_pool.drain(file_tasks[index])
 
-            print('\nFinished processing file %s in %s - %s of %s rows processed' %(log_filename, str(datetime.timedelta(seconds = int(time.time() - time_start))), log_session.rows_prepared, log_session.rows_processed,))
+            if not prog_options.follow:
+                os.unlink(log_filename)             
 
-        os.unlink(log_filename)             
+    if parse_pool:
+        parse_pool.close()
 
     pgsql_conn.close()
 